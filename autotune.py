@@ -0,0 +1,136 @@
+"""Benchmarks chunk sizes for training, rendering and mesh extraction and writes them to a per-machine profile."""
+
+import os,sys,time
+import torch
+import importlib
+import yaml
+from easydict import EasyDict as edict
+
+import options
+import util
+from util import log
+
+# python3 autotune.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue
+#                     --autotune.mesh!          (tune the training/rendering chunks only)
+#
+# the profile is written to options/profiles/<host>/<yaml>.yaml and merged by options.set() in later runs
+# (the tuned nerf.rand_rays changes the training results and is only used with --profile=train)
+
+def get_available_memory(opt):
+    if opt.device=="cpu":
+        return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_AVPHYS_PAGES")
+    return torch.cuda.get_device_properties(opt.device).total_memory-torch.cuda.memory_reserved(opt.device)
+
+def estimate_memory(opt,num_points,train=False):
+    # rough peak memory (in bytes) from the MLP activations at every point (kept for backprop when training)
+    if opt.arch.encoding=="hashgrid":
+        input_3D_dim = 3+opt.arch.hashgrid.levels*opt.arch.hashgrid.feat_dim
+    else: input_3D_dim = 3+6*opt.arch.posenc.L_3D if opt.arch.posenc else 3
+    layers = util.get_layer_dims(opt.arch.layers_feat)+util.get_layer_dims(opt.arch.layers_rgb)
+    width = input_3D_dim+sum(k_out for _,k_out in layers)
+    return num_points*width*4*(3 if train else 1)
+
+def get_num_samples(opt):
+    # number of field evaluations per ray
+    num_samples = opt.nerf.sample_intvs
+    if opt.nerf.fine_sampling: num_samples += opt.nerf.sample_intvs+opt.nerf.sample_intvs_fine
+    if opt.nerf.proposal.sample_intvs: num_samples = opt.nerf.proposal.sample_intvs[-1]
+    return num_samples
+
+def get_candidates(opt,points_per_chunk,train=False):
+    budget = opt.autotune.mem_frac*get_available_memory(opt)
+    candidates = []
+    chunk = opt.autotune.min_chunk
+    while chunk<=opt.autotune.max_chunk and estimate_memory(opt,chunk*points_per_chunk,train=train)<budget:
+        candidates.append(chunk)
+        chunk *= 2
+    return candidates
+
+def benchmark(opt,run,candidates,name):
+    # returns the candidate with the highest throughput (stops at the first one running out of memory)
+    best,best_speed = None,0
+    for chunk in candidates:
+        try:
+            run(chunk) # warm-up
+            if opt.device!="cpu": torch.cuda.synchronize()
+            time_start = time.time()
+            for _ in range(opt.autotune.repeat): run(chunk)
+            if opt.device!="cpu": torch.cuda.synchronize()
+        except RuntimeError as error:
+            print("{0} chunk {1} failed ({2}), stopping".format(name,chunk,str(error).split("\n")[0]))
+            break
+        speed = chunk*opt.autotune.repeat/(time.time()-time_start)
+        print("{0} chunk {1}: {2:.1f}/s".format(name,chunk,speed))
+        if speed>best_speed: best,best_speed = chunk,speed
+        if opt.device!="cpu": torch.cuda.empty_cache()
+    return best
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (autotuning of chunk sizes)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt_cmd.profile = False # benchmark the plain settings
+    opt = options.set(opt_cmd=opt_cmd)
+
+    with torch.cuda.device(opt.device):
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        m.load_dataset(opt)
+        m.build_networks(opt)
+        var = edict({ k: v[:1] for k,v in m.train_data.all.items() }) # a single training view
+
+        def render(chunk,mode):
+            ray_idx = torch.randperm(opt.H*opt.W,device=opt.device)[:chunk]
+            pose = m.graph.get_pose(opt,var,mode=mode)
+            depth,confidence,near,far = None,None,None,None
+            if opt.depth.use_depth:
+                depth,confidence = m.graph.get_gt_depth(opt,var,mode=mode)
+                near,far = m.graph.get_bound(opt,var,mode=mode)
+            outputs = None if mode=="train" else ("rgb","depth","opacity")
+            return m.graph.render(opt,pose,intr=var.intr,ray_idx=ray_idx,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far,outputs=outputs)
+
+        def run_train(chunk):
+            m.graph.zero_grad()
+            ret = render(chunk,mode="train")
+            ret.rgb.sum().backward()
+
+        @torch.no_grad()
+        def run_eval(chunk):
+            render(chunk,mode="val")
+
+        @torch.no_grad()
+        def run_mesh(chunk):
+            # (mesh extraction only queries the density trunk)
+            points = torch.rand(1,chunk,3,device=opt.device)
+            m.graph.nerf.forward_feat(opt,points,mode=None)
+
+        profile = edict()
+        num_samples = get_num_samples(opt)
+        if opt.autotune.train:
+            m.graph.train()
+            rand_rays = benchmark(opt,run_train,get_candidates(opt,num_samples,train=True),name="train")
+            if rand_rays: profile.nerf = edict(rand_rays=rand_rays)
+        if opt.autotune.eval:
+            m.graph.eval()
+            render_chunk = benchmark(opt,run_eval,get_candidates(opt,num_samples),name="eval")
+            if render_chunk: profile.setdefault("nerf",edict()).update(render_chunk=render_chunk)
+        if opt.autotune.mesh and "trimesh" in opt:
+            m.graph.eval()
+            chunk_size = benchmark(opt,run_mesh,get_candidates(opt,1),name="mesh")
+            if chunk_size: profile.trimesh = edict(chunk_size=chunk_size)
+
+        # merge with the existing profile so that the chunk sizes can be tuned separately
+        profile_fname = options.get_profile_fname(opt.yaml)
+        if os.path.isfile(profile_fname):
+            with open(profile_fname) as file:
+                profile = options.override_options(edict(yaml.safe_load(file)),profile,key_stack=[])
+        os.makedirs(os.path.dirname(profile_fname),exist_ok=True)
+        with open(profile_fname,"w") as file:
+            yaml.safe_dump(util.to_dict(profile),file,default_flow_style=False,indent=4)
+        log.info("saved profile to {}".format(profile_fname))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,157 @@
+"""Bakes a pretrained model into a sparse voxel grid (density + spherical-harmonic colours) for MLP-free rendering."""
+
+import numpy as np
+import os,sys,time
+import torch
+import torch.nn.functional as torch_F
+import importlib
+import tqdm
+from easydict import EasyDict as edict
+
+import options
+import camera
+import extract_mesh
+from util import log
+from model.nerf import VolumeRendering
+
+# python3 bake.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue --resume
+#
+# the grid is saved to <output_path>/baked.npz, add --baked.render to render the novel-view videos from it
+
+SH_C0 = 0.28209479177387814
+SH_C1 = 0.4886025119029199
+SH_C2 = [1.0925484305920792,-1.0925484305920792,0.31539156525252005,-1.0925484305920792,0.5462742152960396]
+
+def get_sh_basis(dirs,degree): # [...,3]
+    # real spherical harmonics up to the given degree (0-2)
+    x,y,z = dirs.unbind(dim=-1)
+    basis = [torch.full_like(x,SH_C0)]
+    if degree>=1:
+        basis += [-SH_C1*y,SH_C1*z,-SH_C1*x]
+    if degree>=2:
+        basis += [SH_C2[0]*x*y,SH_C2[1]*y*z,SH_C2[2]*(2*z*z-x*x-y*y),SH_C2[3]*x*z,SH_C2[4]*(x*x-y*y)]
+    return torch.stack(basis,dim=-1) # [...,M]
+
+def get_sphere_dirs(num_dirs):
+    # roughly uniform directions on the unit sphere (Fibonacci lattice)
+    i = torch.arange(num_dirs,dtype=torch.float32)+0.5
+    z = 1-2*i/num_dirs
+    phi = np.pi*(1+5**0.5)*i
+    r = (1-z**2).sqrt()
+    return torch.stack([r*phi.cos(),r*phi.sin(),z],dim=-1) # [D,3]
+
+@torch.no_grad()
+def bake_grid(opt,nerf):
+    # 1. query the density on the dense grid and keep the occupied voxels
+    query = extract_mesh.get_grid_points(opt.baked.range,opt.baked.res)
+    query_flat = query.view(-1,3)
+    get_density = lambda points: nerf.forward_feat(opt,points,mode=None)[1]
+    density_all = extract_mesh.query_grid(opt,query_flat,get_density,opt.baked.chunk_size) # [V]
+    occupied = (density_all>opt.baked.thres).nonzero()[:,0] # [P]
+    log.info("{0} of {1} voxels occupied".format(len(occupied),len(density_all)))
+    # 2. fit spherical harmonics to the colours seen from a set of view directions
+    dirs = get_sphere_dirs(opt.baked.num_dirs).to(opt.device) # [D,3]
+    degree = opt.baked.sh_degree if opt.nerf.view_dep else 0
+    basis = get_sh_basis(dirs,degree) # [D,M]
+    basis_pinv = torch.linalg.pinv(basis) # [M,D]
+    view_bias = nerf.get_view_bias(opt,dirs) if opt.nerf.view_dep else None # [D,K]
+    def get_sh(points):
+        feat,_ = nerf.forward_feat(opt,points[0],mode=None) # [P,K]
+        if opt.nerf.view_dep:
+            rgb = nerf.forward_rgb(opt,feat[:,None],view_bias=view_bias) # [P,D,3]
+        else: rgb = nerf.forward_rgb(opt,feat)[:,None].expand(-1,len(dirs),-1) # [P,D,3]
+        sh = basis_pinv@rgb # [P,M,3]
+        return sh[None]
+    sh = extract_mesh.query_grid(opt,query_flat[occupied],get_sh,opt.baked.chunk_size) # [P,M,3]
+    baked = dict(res=opt.baked.res,range=np.array(opt.baked.range,dtype=np.float32),sh_degree=degree,
+                 index=occupied.numpy().astype(np.int64),
+                 density=density_all[occupied].numpy().astype(np.float16),
+                 sh=sh.numpy().astype(np.float16))
+    return baked
+
+class BakedGrid():
+
+    def __init__(self,opt,fname):
+        baked = np.load(fname)
+        self.res = int(baked["res"])
+        self.range = baked["range"].tolist()
+        self.sh_degree = int(baked["sh_degree"])
+        # dense lookup table from voxel to its entry in the sparse arrays (-1 for empty voxels)
+        self.index = torch.full([(self.res+1)**3],-1,dtype=torch.long,device=opt.device)
+        self.index[torch.from_numpy(baked["index"]).to(opt.device)] = torch.arange(len(baked["index"]),device=opt.device)
+        self.density = torch.from_numpy(baked["density"]).float().to(opt.device) # [P]
+        self.sh = torch.from_numpy(baked["sh"]).float().to(opt.device) # [P,M,3]
+
+    def lookup(self,points_3D): # [...,3]
+        # nearest voxel of each point
+        range_min,range_max = self.range
+        coord = ((points_3D-range_min)/(range_max-range_min)*self.res).round_().long() # [...,3]
+        inside = ((coord>=0)&(coord<=self.res)).all(dim=-1)
+        coord = coord.clamp_(min=0,max=self.res)
+        voxel = self.index[(coord[...,0]*(self.res+1)+coord[...,1])*(self.res+1)+coord[...,2]] # [...]
+        return voxel.masked_fill_(~inside,-1)
+
+    @torch.no_grad()
+    def render_rays(self,opt,center,ray,thres=1e-4): # [B,R,3]
+        # midpoints of the depth strata, as in Graph.sample_depth (in the space of the rays, i.e. NDC if camera.ndc)
+        depth_min,depth_max = opt.nerf.depth.range
+        depth_samples = torch.linspace(depth_min,depth_max,opt.nerf.sample_intvs+1,device=opt.device) # [N+1]
+        depth_samples = (0.5*(depth_samples[:-1]+depth_samples[1:]))[None,None,:,None].expand(*ray.shape[:2],-1,1) # [B,R,N,1]
+        depth_samples = dict(
+            metric=depth_samples,
+            inverse=1/(depth_samples+1e-8),
+        )[opt.nerf.depth.param]
+        points_3D_samples = camera.get_3D_points_from_depth(opt,center,ray,depth_samples,multi_samples=True) # [B,R,N,3]
+        voxel = self.lookup(points_3D_samples) # [B,R,N]
+        density_samples = torch.where(voxel>=0,self.density[voxel.clamp(min=0)],torch.zeros_like(depth_samples[...,0])) # [B,R,N]
+        prob,_,_ = VolumeRendering.compute_prob(density_samples,depth_samples,ray.norm(dim=-1,keepdim=True)) # [B,R,N]
+        # evaluate the colours only where they contribute
+        keep = prob>thres # [B,R,N]
+        ray_unit = torch_F.normalize(ray,dim=-1)[:,:,None].expand_as(points_3D_samples)[keep] # [S,3]
+        basis = get_sh_basis(ray_unit,self.sh_degree) # [S,M]
+        rgb_samples = torch.zeros(*prob.shape,3,device=opt.device) # [B,R,N,3]
+        rgb_samples[keep] = (basis[...,None]*self.sh[voxel[keep]]).sum(dim=-2).clamp_(min=0,max=1) # [S,3]
+        prob = prob[...,None] # [B,R,N,1]
+        rgb = (rgb_samples*prob).sum(dim=2) # [B,R,3]
+        depth = (depth_samples*prob).sum(dim=2) # [B,R,1]
+        opacity = prob.sum(dim=2) # [B,R,1]
+        if opt.nerf.setbg_opaque:
+            rgb = rgb+opt.data.bgcolor*(1-opacity)
+        return edict(rgb=rgb,depth=depth,opacity=opacity)
+
+    @torch.no_grad()
+    def render_by_slices(self,opt,pose,intr=None,chunk=65536):
+        center,ray = camera.get_center_and_ray(opt,pose,intr=intr) # [B,HW,3]
+        if opt.camera.ndc:
+            center,ray = camera.convert_NDC(opt,center,ray,intr=intr)
+        ret_all = edict(rgb=[],depth=[],opacity=[])
+        for c in range(0,ray.shape[1],chunk):
+            ret = self.render_rays(opt,center[:,c:c+chunk],ray[:,c:c+chunk])
+            for k in ret_all: ret_all[k].append(ret[k])
+        for k in ret_all: ret_all[k] = torch.cat(ret_all[k],dim=1) # [B,HW,K]
+        return ret_all
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (baking NeRF/BARF into a sparse voxel grid)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+
+    with torch.cuda.device(opt.device):
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        m.load_dataset(opt,eval_split="test")
+        m.build_networks(opt)
+        m.restore_checkpoint(opt)
+        m.graph.eval()
+
+        baked = bake_grid(opt,m.graph.nerf)
+        baked_fname = "{}/baked.npz".format(opt.output_path)
+        np.savez(baked_fname,**baked)
+        log.info("saved baked grid to {}".format(baked_fname))
+
+if __name__=="__main__":
+    main()
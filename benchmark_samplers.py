@@ -0,0 +1,100 @@
+"""Compares the convergence of short training runs with the uniform and low-discrepancy (Sobol/Halton) samplers."""
+
+import numpy as np
+import os,sys,time
+import torch
+import importlib
+import copy
+import tqdm
+from easydict import EasyDict as edict
+
+import options
+import util
+from util import log
+
+# python3 benchmark_samplers.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue
+#                               --sampler_bench.iters=5000 --nerf.rand_rays=512
+#
+# every sampler is used for both the ray selection and the depth jitter, starting from the same initialization
+# the validation PSNR (and the pose error for BARF) over the iterations is written to <output_path>/sampler_bench.csv
+
+@torch.no_grad()
+def evaluate(opt,m):
+    m.graph.eval()
+    psnr_all = []
+    for batch in m.test_loader:
+        var = edict(util.move_to_device(batch,opt.device))
+        var = m.graph.forward(opt,var,mode="val")
+        loss = m.graph.compute_loss(opt,var,mode="val")
+        psnr_all.append(-10*loss.render.log10().item())
+    result = edict(psnr=np.mean(psnr_all))
+    if hasattr(m,"prealign_cameras") and opt.data.dataset in ["iphone","arkit","blender","llff"]:
+        pose,pose_GT = m.get_all_training_poses(opt)
+        pose_aligned,_ = m.prealign_cameras(opt,pose,pose_GT)
+        error = m.evaluate_camera_alignment(opt,pose_aligned,pose_GT)
+        result.update(rot=np.rad2deg(error.R.mean().item()),trans=error.t.mean().item())
+    m.graph.train()
+    return result
+
+def run(opt,m):
+    torch.manual_seed(opt.seed or 0)
+    m.build_networks(opt)
+    m.setup_optimizer(opt)
+    m.graph.train()
+    m.timer = edict(start=time.time(),it_mean=None)
+    m.ep,m.it = 0,0
+    ray_bank = m.build_ray_bank(opt,m.train_data.all) if opt.nerf.ray_bank and opt.nerf.rand_rays else None
+    curve = []
+    time_start = time.time()
+    loader = tqdm.trange(opt.sampler_bench.iters,desc=opt.nerf.ray_sampler,leave=False)
+    for _ in loader:
+        var = m.get_train_batch(opt,ray_bank=ray_bank)
+        m.train_iteration(opt,var,loader)
+        if opt.optim.sched: m.sched.step()
+        if m.it%opt.sampler_bench.freq==0 or m.it==opt.sampler_bench.iters:
+            # (the evaluation time is excluded)
+            time_train = time.time()-time_start
+            curve.append(edict(it=m.it,time=time_train,**evaluate(opt,m)))
+            time_start = time.time()-time_train
+    return curve
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (convergence benchmark of the ray/depth samplers)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+    # short runs: schedule over the benchmark length and skip the training logs
+    opt.max_iter = opt.sampler_bench.iters
+    opt.freq.scalar = opt.freq.vis = opt.max_iter+1
+
+    with torch.cuda.device(opt.device):
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        m.load_dataset(opt)
+
+        results = edict()
+        for name in opt.sampler_bench.samplers:
+            opt_run = copy.deepcopy(opt)
+            opt_run.nerf.ray_sampler = opt_run.nerf.depth_sampler = name
+            results[name] = run(opt_run,m)
+            print("{0}: PSNR {1:.2f} after {2} iterations ({3:.1f}s)".format(name,results[name][-1].psnr,results[name][-1].it,results[name][-1].time))
+
+        # iterations each sampler needs to reach the final PSNR of the first one (e.g. uniform)
+        target = results[opt.sampler_bench.samplers[0]][-1].psnr
+        for name,curve in results.items():
+            reached = [c.it for c in curve if c.psnr>=target]
+            print("{0}: reached PSNR {1:.2f} at iteration {2}".format(name,target,reached[0] if reached else "-"))
+
+        csv_fname = "{}/sampler_bench.csv".format(opt.output_path)
+        keys = list(results[opt.sampler_bench.samplers[0]][0].keys())
+        with open(csv_fname,"w") as file:
+            file.write(",".join(["sampler"]+keys)+"\n")
+            for name,curve in results.items():
+                for c in curve: file.write(",".join([name]+[str(c[k]) for k in keys])+"\n")
+        log.info("saved results to {}".format(csv_fname))
+
+if __name__=="__main__":
+    main()
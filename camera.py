@@ -231,26 +231,46 @@ def angle_to_rotation_matrix(a,axis):
     M = M.roll((roll,roll),dims=(-2,-1))
     return M
 
-def get_center_and_ray(opt,pose,intr=None): # [HW,2]
+# the (homogeneous) pixel grid only depends on the image size, the intrinsics are applied per call
+pixel_grid_cache = {}
+
+def get_pixel_grid(opt,device):
+    key = (opt.H,opt.W,str(device))
+    if key not in pixel_grid_cache:
+        with torch.no_grad():
+            # compute image coordinate grid
+            y_range = torch.arange(opt.H,dtype=torch.float32,device=device).add_(0.5)
+            x_range = torch.arange(opt.W,dtype=torch.float32,device=device).add_(0.5)
+            Y,X = torch.meshgrid(y_range,x_range) # [H,W]
+            xy_grid = torch.stack([X,Y],dim=-1).view(-1,2) # [HW,2]
+            pixel_grid_cache[key] = to_hom(xy_grid) # [HW,3]
+    return pixel_grid_cache[key]
+
+def get_center_and_ray(opt,pose,intr=None,ray_idx=None): # [HW,2]
     # given the intrinsic/extrinsic matrices, get the camera center and ray directions]
+    # (only the rays of the pixels in ray_idx are transformed if given)
     assert(opt.camera.model=="perspective")
-    with torch.no_grad():
-        # compute image coordinate grid
-        y_range = torch.arange(opt.H,dtype=torch.float32,device=opt.device).add_(0.5)
-        x_range = torch.arange(opt.W,dtype=torch.float32,device=opt.device).add_(0.5)
-        Y,X = torch.meshgrid(y_range,x_range) # [H,W]
-        xy_grid = torch.stack([X,Y],dim=-1).view(-1,2) # [HW,2]
-    # compute center and ray
-    batch_size = len(pose)
-    xy_grid = xy_grid.repeat(batch_size,1,1) # [B,HW,2]
-    grid_3D = img2cam(to_hom(xy_grid),intr) # [B,HW,3]
-    center_3D = torch.zeros_like(grid_3D) # [B,HW,3]
+    xy_grid = get_pixel_grid(opt,intr.device) # [HW,3]
+    if ray_idx is not None:
+        xy_grid = xy_grid[ray_idx] # [R,3]
+    grid_3D = img2cam(xy_grid,intr) # [B,R,3]
     # transform from camera to world coordinates
-    grid_3D = cam2world(grid_3D,pose) # [B,HW,3]
-    center_3D = cam2world(center_3D,pose) # [B,HW,3]
-    ray = grid_3D-center_3D # [B,HW,3]
+    # all rays share the camera center and the ray directions are only rotated (R_inv=R^T)
+    center_3D = cam2world(torch.zeros_like(grid_3D[:,:1]),pose) # [B,1,3]
+    ray = grid_3D@pose[...,:3] # [B,R,3]
+    center_3D = center_3D.expand_as(ray) # [B,R,3]
     return center_3D,ray
 
+def get_center_and_ray_per_pixel(opt,pose,intr,image_idx,ray_idx): # [N,3,4],[N,3,3],[R],[R]
+    # rays of individual pixels from different cameras (e.g. gathered from the ray bank)
+    assert(opt.camera.model=="perspective")
+    xy_grid = get_pixel_grid(opt,intr.device)[ray_idx] # [R,3]
+    grid_3D = (intr.inverse()[image_idx]@xy_grid[...,None])[...,0] # [R,3]
+    pose = pose[image_idx] # [R,3,4]
+    center_3D = cam2world(torch.zeros_like(grid_3D[:,None]),pose) # [R,1,3]
+    ray = grid_3D[:,None]@pose[...,:3] # [R,1,3]
+    return center_3D.transpose(0,1),ray.transpose(0,1) # [1,R,3]
+
 def get_3D_points_from_depth(opt,center,ray,depth,multi_samples=False):
     if multi_samples: center,ray = center[:,:,None],ray[:,:,None]
     # x = c+dv
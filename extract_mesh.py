@@ -6,44 +6,190 @@ import sys
 import numpy as np
 import options
 import torch
+import torch.nn.functional as torch_F
+import torch.multiprocessing as mp
 import tqdm
 import trimesh
 import mcubes
+from easydict import EasyDict as edict
 
+import camera
 from util import log,debug
 
 # python3 extract_mesh.py --group=arkit --model=barf --yaml=barf_arkit --name=llff_main_computers_03 --data.scene=llff_main_computers --data.val_sub= --resume
 # python3 extract_mesh.py --group=blender --model=barf --yaml=barf_blender --name=lego --data.scene=lego --data.val_sub= --resume
+#                         --trimesh.color=cameras --trimesh.format=ply     (vertex colours averaged over the visible training views)
 
-opt_cmd = options.parse_arguments(sys.argv[1:])
-opt = options.set(opt_cmd=opt_cmd)
+def get_grid_points(grid_range,res):
+    t = torch.linspace(*grid_range,res+1) # the best range might vary from model to model
+    query = torch.stack(torch.meshgrid(t,t,t),dim=-1) # [R+1,R+1,R+1,3]
+    return query
 
-with torch.cuda.device(opt.device),torch.no_grad():
+def query_grid(opt,points_flat,func,chunk_size):
+    # evaluate func on chunks of 3D points (moved to the device) and gather the outputs on CPU
+    output_all = []
+    for i in tqdm.trange(0,len(points_flat),chunk_size,leave=False):
+        points = points_flat[None,i:i+chunk_size].to(opt.device) # [1,P,3]
+        output_all.append(func(points)[0].cpu())
+    return torch.cat(output_all,dim=0)
 
-    model = importlib.import_module("model.{}".format(opt.model))
-    m = model.Model(opt)
-    m.load_dataset(opt, eval_split="test") # 여기 추가
-    m.build_networks(opt)
-    m.restore_checkpoint(opt)
-    t = torch.linspace(*opt.trimesh.range,opt.trimesh.res+1) # the best range might vary from model to model
-
-    query = torch.stack(torch.meshgrid(t,t,t),dim=-1)
-    query_flat = query.view(-1,3)
-
-    density_all = []
-    for i in tqdm.trange(0,len(query_flat),opt.trimesh.chunk_size,leave=False):
-        points = query_flat[None,i:i+opt.trimesh.chunk_size].to(opt.device)
-        ray_unit = torch.zeros_like(points) # dummy ray to comply with interface, not used
-        _,density_samples = m.graph.nerf.forward(opt,points,ray_unit=ray_unit,mode=None)
-        density_all.append(density_samples.cpu())
-    density_all = torch.cat(density_all,dim=1)[0]
+def extract_dense(opt,get_density):
+    query = get_grid_points(opt.trimesh.range,opt.trimesh.res)
+    density_all = query_grid(opt,query.view(-1,3),get_density,opt.trimesh.chunk_size)
     density_all = density_all.view(*query.shape[:-1]).numpy()
-
     log.info("running marching cubes...")
     vertices,triangles = mcubes.marching_cubes(density_all,opt.trimesh.thres)
-    vertices_centered = vertices/opt.trimesh.res-0.5
-    mesh = trimesh.Trimesh(vertices_centered,triangles)
+    return vertices,triangles
+
+def extract_hierarchical(opt,get_density):
+    # evaluate a coarse grid first, then query the fine grid only within (dilated) coarse cells crossing the threshold
+    res,res_coarse = opt.trimesh.res,opt.trimesh.coarse_res
+    assert(res%res_coarse==0)
+    factor = res//res_coarse
+    query_coarse = get_grid_points(opt.trimesh.range,res_coarse)
+    density_coarse = query_grid(opt,query_coarse.view(-1,3),get_density,opt.trimesh.chunk_size)
+    density_coarse = density_coarse.view(*query_coarse.shape[:-1]) # [Rc+1,Rc+1,Rc+1]
+    # find the cells whose corners are on both sides of the threshold
+    corners = torch.stack([density_coarse[i:res_coarse+i,j:res_coarse+j,k:res_coarse+k] for i in (0,1) for j in (0,1) for k in (0,1)],dim=0) # [8,Rc,Rc,Rc]
+    crossing = (corners.min(dim=0).values<=opt.trimesh.thres)&(corners.max(dim=0).values>opt.trimesh.thres) # [Rc,Rc,Rc]
+    crossing = torch_F.max_pool3d(crossing[None,None].float(),kernel_size=3,stride=1,padding=1)[0,0].bool() # dilate by one cell
+    log.info("refining {0} of {1} coarse cells...".format(crossing.sum().item(),crossing.numel()))
+    # the fine volume is streamed slab by slab (along x) into a (memory-mapped) array
+    if opt.trimesh.memmap:
+        volume_fname = "{}/density.npy".format(opt.output_path)
+        density_fine = np.lib.format.open_memmap(volume_fname,mode="w+",dtype=np.float32,shape=(res+1,)*3)
+    else: density_fine = np.empty((res+1,)*3,dtype=np.float32)
+    t = torch.linspace(*opt.trimesh.range,res+1)
+    offset = torch.stack(torch.meshgrid(*[torch.arange(factor+1)]*3),dim=-1).view(-1,3) # [(F+1)^3,3]
+    for i in tqdm.trange(res_coarse,desc="refining slabs",leave=False):
+        # fill the slab by trilinear upsampling (exact where no cell crosses the threshold)
+        slab = torch_F.interpolate(density_coarse[None,None,i:i+2],size=(factor+1,res+1,res+1),mode="trilinear",align_corners=True)[0,0] # [F+1,R+1,R+1]
+        cells = crossing[i].nonzero() # [C,2]
+        if len(cells):
+            # query the fine grid points of all crossing cells in the slab
+            idx = torch.cat([torch.full_like(cells[:,:1],i),cells],dim=-1)[:,None]*factor+offset # [C,(F+1)^3,3]
+            idx = idx.view(-1,3)
+            points = torch.stack([t[idx[:,0]],t[idx[:,1]],t[idx[:,2]]],dim=-1) # [C(F+1)^3,3]
+            density = query_grid(opt,points,get_density,opt.trimesh.chunk_size)
+            slab[idx[:,0]-i*factor,idx[:,1],idx[:,2]] = density
+        density_fine[i*factor:(i+1)*factor+1] = slab.numpy()
+    if opt.trimesh.memmap: density_fine.flush()
+    # run marching cubes slab by slab on the volume (only the current slab is read back into memory)
+    log.info("running marching cubes...")
+    vertices_all,triangles_all = [],[]
+    num_vertices = 0
+    for i in tqdm.trange(res_coarse,desc="marching slabs",leave=False):
+        if not crossing[i].any(): continue
+        slab = np.array(density_fine[i*factor:(i+1)*factor+1]) # [F+1,R+1,R+1]
+        vertices,triangles = mcubes.marching_cubes(slab,opt.trimesh.thres)
+        vertices[:,0] += i*factor # shift the slab into place
+        vertices_all.append(vertices)
+        triangles_all.append(triangles+num_vertices)
+        num_vertices += len(vertices)
+    vertices = np.concatenate(vertices_all,axis=0) if vertices_all else np.zeros([0,3])
+    triangles = np.concatenate(triangles_all,axis=0) if triangles_all else np.zeros([0,3],dtype=np.int64)
+    return vertices,triangles
+
+def orient_normals(opt,get_density,vertices,normals,eps=1e-3): # [V,3]
+    # flip the normals towards the lower density (outside of the surface)
+    density_pos = query_grid(opt,vertices+eps*normals,get_density,opt.trimesh.chunk_size) # [V]
+    density_neg = query_grid(opt,vertices-eps*normals,get_density,opt.trimesh.chunk_size) # [V]
+    return torch.where((density_pos<=density_neg)[:,None],normals,-normals) # [V,3]
+
+def get_rgb(opt,nerf,inputs): # [1,P,6]
+    points,ray_unit = inputs[...,:3],inputs[...,3:] # [1,P,3]
+    feat,_ = nerf.forward_feat(opt,points,mode=None) # [1,P,K]
+    view_bias = nerf.get_view_bias(opt,ray_unit) if opt.nerf.view_dep else None # [1,P,K]
+    return nerf.forward_rgb(opt,feat,view_bias=view_bias) # [1,P,3]
+
+color_worker = edict() # per-process state of the colour query workers (set once when the worker starts)
+
+def init_color_worker(opt,nerf,num_threads):
+    # the network is inherited from the parent (fork) and its weights live in shared memory (as in render_pool)
+    torch.set_num_threads(num_threads)
+    color_worker.update(opt=opt,nerf=nerf)
+
+@torch.no_grad()
+def query_rgb_chunk(inputs): # [P,6]
+    return get_rgb(color_worker.opt,color_worker.nerf,inputs[None])[0] # [P,3]
+
+def get_vertex_colors_normal(opt,nerf,vertices,normals): # [V,3]
+    # query the radiance at each vertex as seen from along its (outward) normal
+    inputs = torch.cat([vertices,-normals],dim=-1) # [V,6]
+    if opt.trimesh.workers and opt.device=="cpu":
+        # evaluate the chunks in parallel worker processes
+        num_threads = max(torch.get_num_threads()//opt.trimesh.workers,1)
+        nerf.share_memory()
+        chunks = inputs.split(opt.trimesh.chunk_size)
+        with mp.get_context("fork").Pool(opt.trimesh.workers,initializer=init_color_worker,initargs=(opt,nerf,num_threads)) as pool:
+            rgb_all = list(tqdm.tqdm(pool.imap(query_rgb_chunk,chunks),total=len(chunks),leave=False))
+        return torch.cat(rgb_all,dim=0) # [V,3]
+    return query_grid(opt,inputs,lambda inputs: get_rgb(opt,nerf,inputs),opt.trimesh.chunk_size) # [V,3]
+
+def get_vertex_colors_cameras(opt,vertices,pose,intr,image,eps=1e-6): # [V,3],[N,3,4],[N,3,3],[N,3,H,W]
+    # average the pixel colours of all training views in which a vertex is visible
+    # (visibility: the vertex is at most visibility_tol behind the z-buffer of the splatted vertices)
+    vertices = vertices.to(opt.device)
+    rgb_sum = torch.zeros(len(vertices),3,device=opt.device) # [V,3]
+    count = torch.zeros(len(vertices),device=opt.device) # [V]
+    for i in tqdm.trange(len(pose),desc="projecting to views",leave=False):
+        points_cam = camera.world2cam(vertices,pose[i]) # [V,3]
+        points_img = camera.cam2img(points_cam,intr[i]) # [V,3]
+        z = points_cam[:,2]
+        uv = (points_img[:,:2]/z.clamp(min=eps)[:,None]).floor().long() # [V,2]
+        inside = (z>eps)&(uv[:,0]>=0)&(uv[:,0]<opt.W)&(uv[:,1]>=0)&(uv[:,1]<opt.H)
+        pixel = uv[:,1]*opt.W+uv[:,0] # [V]
+        zbuf = np.full(opt.H*opt.W,np.inf,dtype=np.float32)
+        np.minimum.at(zbuf,pixel[inside].cpu().numpy(),z[inside].cpu().numpy())
+        zbuf = torch.from_numpy(zbuf).to(opt.device) # [HW]
+        visible = inside&(z<=zbuf[pixel.clamp(min=0,max=opt.H*opt.W-1)]*(1+opt.trimesh.visibility_tol))
+        rgb_sum[visible] += image[i].view(3,-1)[:,pixel[visible]].t()
+        count[visible] += 1
+    log.info("{0} of {1} vertices not visible in any view".format((count==0).sum().item(),len(vertices)))
+    return (rgb_sum/count.clamp(min=1)[:,None]).cpu() # [V,3]
+
+def main():
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+
+    with torch.cuda.device(opt.device),torch.no_grad():
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        m.load_dataset(opt, eval_split="test") # 여기 추가
+        m.build_networks(opt)
+        m.restore_checkpoint(opt)
+
+        def get_density(points):
+            # density-only forward (the RGB head is skipped)
+            _,density_samples = m.graph.nerf.forward_feat(opt,points,mode=None)
+            return density_samples
+
+        if opt.trimesh.coarse_res:
+            vertices,triangles = extract_hierarchical(opt,get_density)
+        else: vertices,triangles = extract_dense(opt,get_density)
+        vertices_centered = vertices/opt.trimesh.res-0.5
+        mesh = trimesh.Trimesh(vertices_centered,triangles) # (duplicate vertices on the slab boundaries are merged)
+
+        if opt.trimesh.color:
+            log.info("computing vertex colours ({})...".format(opt.trimesh.color))
+            range_min,range_max = opt.trimesh.range
+            vertices_world = torch.tensor((mesh.vertices+0.5)*(range_max-range_min)+range_min,dtype=torch.float32) # [V,3]
+            if opt.trimesh.color=="normal":
+                normals = torch.tensor(mesh.vertex_normals,dtype=torch.float32) # [V,3]
+                normals = orient_normals(opt,get_density,vertices_world,normals)
+                rgb = get_vertex_colors_normal(opt,m.graph.nerf,vertices_world,normals)
+            elif opt.trimesh.color=="cameras":
+                # use the refined poses if they are optimized (BARF)
+                pose = m.get_all_training_poses(opt)[0] if hasattr(m.graph,"se3_refine") else m.train_data.all.pose
+                rgb = get_vertex_colors_cameras(opt,vertices_world,pose.to(opt.device),m.train_data.all.intr.to(opt.device),m.train_data.all.image.to(opt.device))
+            else: raise ValueError("unknown vertex colour mode: {}".format(opt.trimesh.color))
+            rgba = torch.cat([rgb.clamp(0,1),torch.ones_like(rgb[:,:1])],dim=-1) # [V,4]
+            mesh.visual.vertex_colors = (rgba*255).round().byte().numpy()
+
+        mesh_fname = "{0}/mesh.{1}".format(opt.output_path,opt.trimesh.format)
+        log.info("saving 3D mesh to {}...".format(mesh_fname))
+        mesh.export(mesh_fname)
 
-    obj_fname = "{}/mesh.obj".format(opt.output_path)
-    log.info("saving 3D mesh to {}...".format(obj_fname))
-    mesh.export(obj_fname)
+if __name__=="__main__":
+    main()
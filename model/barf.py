@@ -29,12 +29,13 @@ class Model(nerf.Model):
             # pre-generate synthetic pose perturbation
             se3_noise = torch.randn(len(self.train_data),6,device=opt.device)*opt.camera.noise
             self.graph.pose_noise = camera.lie.se3_to_SE3(se3_noise)
-        self.graph.se3_refine = torch.nn.Embedding(len(self.train_data),6).to(opt.device) #TODO : refine되는 포즈?, (n,6) : 6개로 나타내나봐
+        self.graph.se3_refine = torch.nn.Embedding(len(self.train_data),6,sparse=opt.optim.sparse_pose).to(opt.device) #TODO : refine되는 포즈?, (n,6) : 6개로 나타내나봐
         torch.nn.init.zeros_(self.graph.se3_refine.weight) #(n,6) shape의 0으로 채워진 행렬
 
     def setup_optimizer(self,opt):
         super().setup_optimizer(opt)
-        optimizer = getattr(torch.optim,opt.optim.algo)  #Adam
+        # with sparse gradients, only the poses of the images in the current minibatch are updated
+        optimizer = torch.optim.SparseAdam if opt.optim.sparse_pose else getattr(torch.optim,opt.optim.algo)  #Adam
         self.optim_pose = optimizer([dict(params=self.graph.se3_refine.parameters(),lr=opt.optim.lr_pose)]) #TODO: optimize pose
         # set up scheduler
         if opt.optim.sched_pose:
@@ -59,6 +60,9 @@ class Model(nerf.Model):
         self.graph.nerf.progress.data.fill_(self.it/opt.max_iter)
         if opt.nerf.fine_sampling:
             self.graph.nerf_fine.progress.data.fill_(self.it/opt.max_iter)
+        if opt.nerf.proposal.sample_intvs:
+            for proposal in self.graph.nerf_proposal:
+                proposal.progress.data.fill_(self.it/opt.max_iter)
         return loss
 
     @torch.no_grad()
@@ -190,7 +194,9 @@ class Model(nerf.Model):
             # loss.all.backward()
             loss.all.backward(retain_graph=True)
             optim_pose.step()
-            iterator.set_postfix(loss="{:.3f}".format(loss.all))
+            if opt.nerf.deferred_rgb.thres:
+                iterator.set_postfix(loss="{:.3f}".format(loss.all),rgb_keep="{:.3f}".format(float(self.graph.rgb_keep_ratio)))
+            else: iterator.set_postfix(loss="{:.3f}".format(loss.all))
         return var
 
     @torch.no_grad()
@@ -428,11 +434,15 @@ class Graph(nerf.Graph):
 
     def __init__(self,opt):
         super().__init__(opt)
-        self.nerf = NeRF(opt)
-        if opt.nerf.fine_sampling:
-            self.nerf_fine = NeRF(opt)
         self.pose_eye = torch.eye(3,4).to(opt.device)
 
+    def build_field(self,opt):
+        if opt.arch.field=="tensorf": return super().build_field(opt)
+        return NeRF(opt)
+
+    def build_proposal(self,opt):
+        return ProposalNeRF(opt)
+
     def get_pose(self,opt,var,mode=None):
         if mode=="train":
             # add the pre-generated pose perturbations
@@ -443,7 +453,7 @@ class Graph(nerf.Graph):
                 else: pose = var.pose
             else: pose = self.pose_eye
             # add learnable pose correction
-            var.se3_refine = self.se3_refine.weight[var.idx] #Embedding(n,6)
+            var.se3_refine = self.se3_refine(var.idx) #Embedding(n,6)
             pose_refine = camera.lie.se3_to_SE3(var.se3_refine) #Embedding(n,6)
             pose = camera.pose.compose([pose_refine,pose])  #(n,3,4)
             # print('### se3_refine : {}'.format(self.se3_refine))
@@ -474,13 +484,22 @@ class NeRF(nerf.NeRF):
     def positional_encoding(self,opt,input,L): # [B,...,N]
         input_enc = super().positional_encoding(opt,input,L=L) # [B,...,2NL]
         # coarse-to-fine: smoothly mask positional encoding for BARF
-        if opt.barf_c2f is not None:
-            # set weights for different frequency bands
-            start,end = opt.barf_c2f
-            alpha = (self.progress.data-start)/(end-start)*L
-            k = torch.arange(L,dtype=torch.float32,device=opt.device)
-            weight = (1-(alpha-k).clamp_(min=0,max=1).mul_(np.pi).cos_())/2
+        weight = self.get_c2f_weight(opt,L=L)
+        if weight is not None:
             # apply weights
             shape = input_enc.shape
             input_enc = (input_enc.view(-1,L)*weight).view(*shape)
         return input_enc
+
+    def get_c2f_weight(self,opt,L):
+        if opt.barf_c2f is None: return None
+        # set weights for different frequency bands (or resolution levels of the hash grid)
+        start,end = opt.barf_c2f
+        alpha = (self.progress.data-start)/(end-start)*L
+        k = torch.arange(L,dtype=torch.float32,device=opt.device)
+        weight = (1-(alpha-k).clamp_(min=0,max=1).mul_(np.pi).cos_())/2
+        return weight
+
+class ProposalNeRF(nerf.ProposalNeRF,NeRF):
+    # density-only proposal network with the same coarse-to-fine positional encoding as the main field
+    pass
@@ -118,10 +118,11 @@ class Model():
         loss = self.graph.compute_loss(opt,var,mode="train")
         loss = self.summarize_loss(opt,var,loss)
         loss.all.backward()
+        if opt.world_size>1: util.all_reduce_grads(opt,self.graph.parameters())
         self.optim.step()
-        # after train iteration
-        if (self.it+1)%opt.freq.scalar==0: self.log_scalars(opt,var,loss,step=self.it+1,split="train")
-        if (self.it+1)%opt.freq.vis==0: self.visualize(opt,var,step=self.it+1,split="train")
+        # after train iteration (logging on rank 0 only)
+        if opt.rank==0 and (self.it+1)%opt.freq.scalar==0: self.log_scalars(opt,var,loss,step=self.it+1,split="train")
+        if opt.rank==0 and (self.it+1)%opt.freq.vis==0: self.visualize(opt,var,step=self.it+1,split="train")
         self.it += 1
         loader.set_postfix(it=self.it,loss="{:.3f}".format(loss.all))
         self.timer.it_end = time.time()
@@ -203,8 +204,9 @@ class Graph(torch.nn.Module):
     def L1_loss(self,pred,label=0):
         loss = (pred.contiguous()-label).abs()
         return loss.mean()
-    def MSE_loss(self,pred,label=0):
+    def MSE_loss(self,pred,label=0,weight=None):
         loss = (pred.contiguous()-label)**2
+        if weight is not None: loss = loss*weight
         return loss.mean()
 
 
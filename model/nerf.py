@@ -15,6 +15,11 @@ from util import log,debug
 from . import base
 import camera
 import importlib
+import render_pool
+import sampler
+
+# columns of the ray bank (one row per training pixel)
+RAY_BANK = edict(rgb=slice(0,3),depth=3,confidence=4,near=5,far=6,image_idx=7,ray_idx=8)
 
 # ============================ main engine for training and evaluation ============================
 
@@ -30,12 +35,29 @@ class Model(base.Model):
         self.train_data.prefetch_all_data(opt)
         self.train_data.all = edict(util.move_to_device(self.train_data.all,opt.device))
 
+    def build_networks(self,opt):
+        super().build_networks(opt)
+        if opt.nerf.ray_sampler=="importance":
+            self.graph.ray_sampler = ErrorSampler(opt,len(self.train_data)).to(opt.device)
+
+    def train_iteration(self,opt,var,loader):
+        # re-randomize the samplers from the iteration number (so that resumed runs draw the same points)
+        for rng in self.graph.rng.values(): rng.set_step(self.it)
+        return super().train_iteration(opt,var,loader)
+
     def setup_optimizer(self,opt):
         log.info("setting up optimizers...")
         optimizer = getattr(torch.optim,opt.optim.algo)
-        self.optim = optimizer([dict(params=self.graph.nerf.parameters(),lr=opt.optim.lr)])
+        self.optim = optimizer([dict(params=self.get_field_params(opt,self.graph.nerf),lr=opt.optim.lr)])
         if opt.nerf.fine_sampling:
-            self.optim.add_param_group(dict(params=self.graph.nerf_fine.parameters(),lr=opt.optim.lr))
+            self.optim.add_param_group(dict(params=self.get_field_params(opt,self.graph.nerf_fine),lr=opt.optim.lr))
+        if opt.arch.field=="tensorf":
+            # the factorized grids are optimized with their own learning rate
+            self.optim.add_param_group(dict(params=self.graph.nerf.grid_parameters(),lr=opt.arch.tensorf.lr_grid))
+            if opt.nerf.fine_sampling:
+                self.optim.add_param_group(dict(params=self.graph.nerf_fine.grid_parameters(),lr=opt.arch.tensorf.lr_grid))
+        if opt.nerf.proposal.sample_intvs:
+            self.optim.add_param_group(dict(params=self.graph.nerf_proposal.parameters(),lr=opt.optim.lr))
         # set up scheduler
         if opt.optim.sched:
             scheduler = getattr(torch.optim.lr_scheduler,opt.optim.sched.type)
@@ -45,6 +67,20 @@ class Model(base.Model):
             kwargs = { k:v for k,v in opt.optim.sched.items() if k!="type" }
             self.sched = scheduler(self.optim,**kwargs)
 
+    def get_field_params(self,opt,field):
+        if opt.arch.field=="tensorf": return field.mlp_parameters()
+        return field.parameters()
+
+    @torch.no_grad()
+    def upsample_fields(self,opt):
+        fields = [self.graph.nerf,self.graph.nerf_fine] if opt.nerf.fine_sampling else [self.graph.nerf]
+        for field in fields:
+            res = field.get_upsample_res(opt,self.it)
+            field.upsample(opt,res)
+            # the grid sizes changed, so reset the optimizer states of the grids
+            for param in field.grid_parameters(): self.optim.state.pop(param,None)
+        log.info("upsampled grids to resolution {}".format(res))
+
     def train(self,opt):
         # before training
         log.title("TRAINING START")
@@ -52,16 +88,29 @@ class Model(base.Model):
         self.graph.train()
         self.ep = 0 # dummy for timer
         # training
-        if self.iter_start==0: self.validate(opt,0)
-        loader = tqdm.trange(opt.max_iter,desc="training",leave=False)
+        if self.iter_start==0:
+            if opt.rank==0: self.validate(opt,0)
+            if opt.world_size>1: torch.distributed.barrier()
+        assert(opt.nerf.ray_sampler!="importance" or opt.nerf.ray_bank) # importance sampling picks individual pixels from the ray bank
+        ray_bank = self.build_ray_bank(opt,self.train_data.all) if opt.nerf.ray_bank and opt.nerf.rand_rays else None
+        loader = tqdm.trange(opt.max_iter,desc="training",leave=False,disable=opt.rank!=0)
         for self.it in loader:
             if self.it<self.iter_start: continue
-            # set var to all available images
-            var = self.train_data.all
+            var = self.get_train_batch(opt,ray_bank=ray_bank)
             self.train_iteration(opt,var,loader,)
             if opt.optim.sched: self.sched.step()
-            if self.it%opt.freq.val==0: self.validate(opt,self.it)
-            if self.it%opt.freq.ckpt==0: self.save_checkpoint(opt,ep=None,it=self.it)
+            if opt.arch.field=="tensorf" and self.it in opt.arch.tensorf.upsample_iters:
+                self.upsample_fields(opt)
+            if opt.nerf.occ_grid.res and self.it>=opt.nerf.occ_grid.warmup and self.it%opt.nerf.occ_grid.freq==0:
+                # query the grid in slices of as many points as a full-image render slice (independent of the training batch)
+                chunk_size = self.graph.get_render_chunk(opt)*self.graph.get_samples_per_ray(opt)
+                self.graph.occ_grid.update(opt,self.graph.nerf,chunk_size=chunk_size)
+                if opt.world_size>1: util.broadcast_module(self.graph.occ_grid) # keep the (randomly jittered) grids identical
+            # validation and checkpoints on rank 0 only (the other ranks wait at the barrier, up to dist.timeout)
+            if self.it%opt.freq.val==0 or self.it%opt.freq.ckpt==0:
+                if opt.rank==0 and self.it%opt.freq.val==0: self.validate(opt,self.it)
+                if opt.rank==0 and self.it%opt.freq.ckpt==0: self.save_checkpoint(opt,ep=None,it=self.it)
+                if opt.world_size>1: torch.distributed.barrier()
         # after training
         if opt.tb:
             self.tb.flush()
@@ -69,6 +118,33 @@ class Model(base.Model):
         if opt.visdom: self.vis.close()
         log.title("TRAINING DONE")
 
+    def get_train_batch(self,opt,ray_bank=None):
+        # set var to all available images
+        var = self.train_data.all
+        if opt.nerf.rand_images:
+            # or to a minibatch of random images (so the per-iteration cost does not grow with the number of images)
+            idx = torch.randperm(len(var.idx),device=opt.device)[:opt.nerf.rand_images]
+            var = edict({ k: v[idx] for k,v in var.items() })
+        if ray_bank is not None: var = edict(var,ray_bank=ray_bank)
+        return var
+
+    @torch.no_grad()
+    def build_ray_bank(self,opt,var):
+        # flatten all training pixels into a single [NHW,K] tensor (see RAY_BANK for the columns)
+        num_images = len(var.idx)
+        columns = [var.image.view(num_images,3,opt.H*opt.W).permute(0,2,1)] # [N,HW,3]
+        if opt.depth.use_depth:
+            depth,confidence = self.graph.get_gt_depth(opt,var,mode="train")
+            near,far = self.graph.get_bound(opt,var,mode="train")
+            columns += [x.reshape(num_images,opt.H*opt.W,1).float() for x in (depth,confidence,near,far)] # [N,HW,1]
+        else: columns.append(torch.zeros(num_images,opt.H*opt.W,4,device=opt.device))
+        image_idx = torch.arange(num_images,device=opt.device,dtype=torch.float32)[:,None,None].expand(-1,opt.H*opt.W,1) # [N,HW,1]
+        ray_idx = torch.arange(opt.H*opt.W,device=opt.device,dtype=torch.float32)[None,:,None].expand(num_images,-1,1) # [N,HW,1]
+        columns += [image_idx,ray_idx]
+        ray_bank = torch.cat(columns,dim=-1).view(num_images*opt.H*opt.W,-1).contiguous() # [NHW,K]
+        log.info("ray bank: {0} rays ({1:.1f} MB)".format(len(ray_bank),ray_bank.numel()*4/2**20))
+        return ray_bank
+
     @torch.no_grad()
     def log_scalars(self,opt,var,loss,metric=None,step=0,split="train"):
         super().log_scalars(opt,var,loss,metric=metric,step=step,split=split)
@@ -85,6 +161,15 @@ class Model(base.Model):
         if opt.nerf.fine_sampling:
             psnr = -10*loss.render_fine.log10()
             self.tb.add_scalar("{0}/{1}".format(split,"PSNR_fine"),psnr,step)
+        # log ratio of samples skipped by the occupancy grid
+        if opt.nerf.occ_grid.res:
+            self.tb.add_scalar("{0}/{1}".format(split,"occ_skip"),float(self.graph.occ_grid.skip_ratio),step)
+        # log ratio of samples kept by packed depth-guided sampling
+        if opt.depth.use_depth and opt.depth.packed_intvs:
+            self.tb.add_scalar("{0}/{1}".format(split,"packed_ratio"),self.graph.packed_ratio,step)
+        # log ratio of samples evaluated by the RGB head in deferred rendering
+        if opt.nerf.deferred_rgb.thres and split!="train":
+            self.tb.add_scalar("{0}/{1}".format(split,"rgb_keep"),float(self.graph.rgb_keep_ratio),step)
 
     @torch.no_grad()
     def visualize(self,opt,var,step=0,split="train",eps=1e-10):
@@ -151,6 +236,21 @@ class Model(base.Model):
     #     return pose,pose_GT
 
 
+    def render_frames(self,opt,frames,mode=None,desc=None,baked=False):
+        # render full frames (dicts of render_by_slices() arguments) in order, in parallel worker processes if enabled
+        # (frames can also be a generator, which is only advanced ahead of the consumer by the frames in flight in the pool)
+        if baked:
+            # render from the sparse voxel grid exported by bake.py (no network evaluation)
+            baked_grid = importlib.import_module("bake").BakedGrid(opt,"{}/baked.npz".format(opt.output_path))
+            for frame in tqdm.tqdm(frames,desc=desc,leave=False):
+                yield baked_grid.render_by_slices(opt,frame.pose,intr=frame.intr,chunk=self.graph.get_render_chunk(opt))
+        elif opt.render_pool.workers and opt.device=="cpu":
+            with render_pool.RenderPool(opt,self.graph) as pool:
+                yield from pool.render(frames,mode=mode,desc=desc)
+        else:
+            for frame in tqdm.tqdm(frames,desc=desc,leave=False):
+                yield self.graph.render_by_slices(opt,**frame,mode=mode)
+
     @torch.no_grad()
     def evaluate_full(self,opt,eps=1e-10):
         self.graph.eval()
@@ -158,13 +258,24 @@ class Model(base.Model):
         res = []
         test_path = "{}/test_view".format(opt.output_path)
         os.makedirs(test_path,exist_ok=True)
-        for i,batch in enumerate(loader):
-            var = edict(batch)
-            var = util.move_to_device(var,opt.device)
-            if opt.data.dataset in ["iphone","arkit","blender","strayscanner"] and opt.optim.test_photo:
-                # run test-time optimization to factorize imperfection in optimized poses from view synthesis evaluation
-                var = self.evaluate_test_time_photometric_optim(opt,var)
-            var = self.graph.forward(opt,var,mode="eval")
+        var_pending = []
+        def get_frames():
+            # the test views are prepared lazily, so only the views being rendered are kept in memory (one per pool worker)
+            for batch in loader:
+                var = edict(batch)
+                var = util.move_to_device(var,opt.device)
+                if opt.data.dataset in ["iphone","arkit","blender","strayscanner"] and opt.optim.test_photo:
+                    # run test-time optimization to factorize imperfection in optimized poses from view synthesis evaluation
+                    var = self.evaluate_test_time_photometric_optim(opt,var)
+                frame = edict(pose=self.graph.get_pose(opt,var,mode="eval"),intr=var.intr,idx=var.idx)
+                if opt.depth.use_depth:
+                    frame.depth,frame.confidence = self.graph.get_gt_depth(opt,var,mode="eval")
+                    frame.near,frame.far = self.graph.get_bound(opt,var,mode="eval")
+                var_pending.append(var)
+                yield frame
+        for i,ret in enumerate(self.render_frames(opt,get_frames(),mode="eval",desc="rendering test views")):
+            var = var_pending.pop(0)
+            var.update(ret)
             # evaluate view synthesis
             invdepth = (1-var.depth)/var.opacity if opt.camera.ndc else 1/(var.depth/var.opacity+eps)
             rgb_map = var.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [B,3,H,W]
@@ -177,6 +288,7 @@ class Model(base.Model):
             torchvision_F.to_pil_image(rgb_map.cpu()[0]).save("{}/rgb_{}.png".format(test_path,i))
             torchvision_F.to_pil_image(var.image.cpu()[0]).save("{}/rgb_GT_{}.png".format(test_path,i))
             torchvision_F.to_pil_image(invdepth_map.cpu()[0]).save("{}/depth_{}.png".format(test_path,i))
+            del var,ret,rgb_map,invdepth,invdepth_map
 
         # show results in terminal
         print("--------------------------")
@@ -224,11 +336,9 @@ class Model(base.Model):
             # rotate novel views around the "center" camera of all poses
             idx_center = (poses - poses.mean(dim=0, keepdim=True))[..., 3].norm(dim=-1).argmin()
             pose_novel = camera.get_novel_view_poses(opt, poses[idx_center], N=1, scale=scale).to(opt.device)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel, desc="ckpt rendering novel views", leave=False)
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device)  # grab intrinsics
-            for i, pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt, pose[None], intr=intr) if opt.nerf.rand_rays else \
-                    self.graph.render(opt, pose[None], intr=intr)
+            frames = [edict(pose=pose[None],intr=intr) for pose in pose_novel]
+            for i,ret in enumerate(self.render_frames(opt,frames,desc="ckpt rendering novel views")):
                 invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
                 rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [B,3,H,W]
                 invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [B,1,H,W]
@@ -253,11 +363,9 @@ class Model(base.Model):
             # rotate novel views around the "center" camera of all poses
             idx_center = (poses - poses.mean(dim=0, keepdim=True))[..., 3].norm(dim=-1).argmin()
             pose_novel = camera.get_novel_view_poses(opt, poses[idx_center], N=1, scale=scale).to(opt.device)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel, desc="ckpt rendering origin novel views", leave=False)
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device)  # grab intrinsics
-            for i, pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt, pose[None], intr=intr) if opt.nerf.rand_rays else \
-                    self.graph.render(opt, pose[None], intr=intr)
+            frames = [edict(pose=pose[None],intr=intr) for pose in pose_novel]
+            for i,ret in enumerate(self.render_frames(opt,frames,desc="ckpt rendering origin novel views")):
                 invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
                 rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [B,3,H,W]
                 invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [B,1,H,W]
@@ -339,11 +447,9 @@ class Model(base.Model):
             # render the novel views
             novel_path = "{}/novel_view".format(opt.output_path)
             os.makedirs(novel_path,exist_ok=True)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel,desc="rendering novel views",leave=False)
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device) # grab intrinsics
-            for i,pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt,pose[None],intr=intr) if opt.nerf.rand_rays else \
-                      self.graph.render(opt,pose[None],intr=intr)
+            frames = [edict(pose=pose[None],intr=intr) for pose in pose_novel]
+            for i,ret in enumerate(self.render_frames(opt,frames,desc="rendering novel views",baked=opt.baked.render)):
                 invdepth = (1-ret.depth)/ret.opacity if opt.camera.ndc else 1/(ret.depth/ret.opacity+eps)
                 rgb_map = ret.rgb.view(-1,opt.H,opt.W,3).permute(0,3,1,2) # [B,3,H,W]
                 invdepth_map = invdepth.view(-1,opt.H,opt.W,1).permute(0,3,1,2) # [B,1,H,W]
@@ -407,11 +513,9 @@ class Model(base.Model):
             # render the novel views
             novel_path = "{}/novel_view_origin".format(opt.output_path)
             os.makedirs(novel_path, exist_ok=True)
-            pose_novel_tqdm = tqdm.tqdm(pose_novel, desc="rendering origin novel views", leave=False)
             intr = edict(next(iter(self.test_loader))).intr[:1].to(opt.device)  # grab intrinsics
-            for i, pose in enumerate(pose_novel_tqdm):
-                ret = self.graph.render_by_slices(opt, pose[None], intr=intr) if opt.nerf.rand_rays else \
-                    self.graph.render(opt, pose[None], intr=intr)
+            frames = [edict(pose=pose[None],intr=intr) for pose in pose_novel]
+            for i,ret in enumerate(self.render_frames(opt,frames,desc="rendering origin novel views",baked=opt.baked.render)):
                 invdepth = (1 - ret.depth) / ret.opacity if opt.camera.ndc else 1 / (ret.depth / ret.opacity + eps)
                 rgb_map = ret.rgb.view(-1, opt.H, opt.W, 3).permute(0, 3, 1, 2)  # [B,3,H,W]
                 invdepth_map = invdepth.view(-1, opt.H, opt.W, 1).permute(0, 3, 1, 2)  # [B,1,H,W]
@@ -432,11 +536,30 @@ class Graph(base.Graph):
 
     def __init__(self,opt):
         super().__init__(opt)
-        self.nerf = NeRF(opt)
+        self.nerf = self.build_field(opt)
         if opt.nerf.fine_sampling:
-            self.nerf_fine = NeRF(opt)
+            self.nerf_fine = self.build_field(opt)
+        if opt.nerf.proposal.sample_intvs:
+            assert(not opt.nerf.fine_sampling)
+            self.nerf_proposal = torch.nn.ModuleList([self.build_proposal(opt) for _ in opt.nerf.proposal.sample_intvs])
+        if opt.nerf.occ_grid.res:
+            self.occ_grid = OccupancyGrid(opt)
+        self.rng = edict(ray=sampler.get_sampler(opt,opt.nerf.ray_sampler),depth=sampler.get_sampler(opt,opt.nerf.depth_sampler))
+        self.rgb_keep_ratio = 1.
+        self.packed_ratio = 1.
+
+    def build_field(self,opt):
+        if opt.arch.field=="tensorf":
+            tensorf = importlib.import_module("model.tensorf")
+            return tensorf.TensoRF(opt)
+        return NeRF(opt)
+
+    def build_proposal(self,opt):
+        return ProposalNeRF(opt)
 
     def forward(self,opt,var,mode=None):
+        if opt.nerf.rand_rays and mode=="train" and "ray_bank" in var:
+            return self.forward_ray_bank(opt,var,mode=mode)
         batch_size = len(var.idx) #forward
         pose = self.get_pose(opt,var,mode=mode)
 
@@ -449,46 +572,137 @@ class Graph(base.Graph):
         # render images
         if opt.nerf.rand_rays and mode in ["train","test-optim"]:
             # sample random rays for optimization
-            var.ray_idx = torch.randperm(opt.H*opt.W,device=opt.device)[:opt.nerf.rand_rays//batch_size]
+            # (drawn within the pixels of this rank for data-parallel training)
+            num_rays = self.get_num_rays(opt,mode=mode)//batch_size
+            shard = self.get_shard(opt,mode=mode)
+            W_shard = self.get_shard_width(opt,shard)
+            if opt.nerf.ray_sampler in ["sobol","halton"]:
+                shard_idx = sampler.get_pixel_index(opt,self.rng.ray.rand(num_rays,2,device=opt.device),W=W_shard)
+            else: shard_idx = torch.randperm(opt.H*W_shard,device=opt.device)[:num_rays]
+            var.ray_idx = self.get_shard_pixel(opt,shard_idx,shard)
             ret = self.render(opt,pose,intr=var.intr,ray_idx=var.ray_idx,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far) # [B,N,3],[B,N,1]
         else:
             # render full image (process in slices)
-            ret = self.render_by_slices(opt,pose,intr=var.intr,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far) if opt.nerf.rand_rays else \
-                  self.render(opt,pose,intr=var.intr,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,3],[B,HW,1]
+            outputs = ["rgb","depth","opacity"]
+            if opt.depth.use_depth_loss and opt.loss_weight.depth>0: outputs += ["prob","depth_samples"] # needed by the depth loss
+            ret = self.render_by_slices(opt,pose,intr=var.intr,mode=mode,idx=var.idx,depth=depth,confidence=confidence,near=near,far=far,outputs=outputs) # [B,HW,3],[B,HW,1]
+        var.update(ret)
+        return var
+
+    def forward_ray_bank(self,opt,var,mode=None):
+        # sample random pixels of the images in var (all or a minibatch) with a single gather from the ray bank
+        # (the rows of each image are contiguous in the bank, starting at idx*HW)
+        pose = self.get_pose(opt,var,mode=mode) # [B,3,4]
+        # (drawn within the pixels of this rank for data-parallel training)
+        num_rays = self.get_num_rays(opt,mode=mode)
+        shard = self.get_shard(opt,mode=mode)
+        W_shard = self.get_shard_width(opt,shard)
+        if opt.nerf.ray_sampler=="importance":
+            image_idx,ray_idx,ray_weight = self.ray_sampler.sample(opt,var.idx,num_rays,shard=shard) # [R]
+            var.ray_weight = ray_weight[None,:,None] # [1,R,1]
+        elif opt.nerf.ray_sampler in ["sobol","halton"]:
+            points = self.rng.ray.rand(num_rays,3,device=opt.device) # [R,3]
+            image_idx = (points[:,0]*len(var.idx)).long().clamp_(max=len(var.idx)-1) # [R]
+            ray_idx = self.get_shard_pixel(opt,sampler.get_pixel_index(opt,points[:,1:],W=W_shard),shard) # [R]
+        else:
+            image_idx = torch.randint(len(var.idx),(num_rays,),device=opt.device) # [R]
+            ray_idx = self.get_shard_pixel(opt,torch.randint(opt.H*W_shard,(num_rays,),device=opt.device),shard) # [R]
+        var.ray_batch = var.ray_bank[var.idx[image_idx]*opt.H*opt.W+ray_idx] # [R,K]
+        center,ray = camera.get_center_and_ray_per_pixel(opt,pose,var.intr,image_idx,ray_idx) # [1,R,3]
+        if opt.camera.ndc:
+            # forward-facing captures share the intrinsics
+            center,ray = camera.convert_NDC(opt,center,ray,intr=var.intr[:1])
+        depth,confidence,near,far = None,None,None,None
+        if opt.depth.use_depth:
+            depth,confidence,near,far = (var.ray_batch[None,:,RAY_BANK[k]] for k in ["depth","confidence","near","far"]) # [1,R]
+        ret = self.render_rays(opt,center,ray,mode=mode,idx=image_idx,depth=depth,confidence=confidence,near=near,far=far) # [1,R,K]
         var.update(ret)
         return var
 
+    def get_num_rays(self,opt,mode=None):
+        # the random rays of a training step are split over the ranks of data-parallel training
+        return opt.nerf.rand_rays//opt.world_size if mode=="train" else opt.nerf.rand_rays
+
+    def get_shard(self,opt,mode=None):
+        # data-parallel training: each rank draws its training rays from its own image columns (x%world_size==rank)
+        return (opt.world_size,opt.rank) if mode=="train" else (1,0)
+
+    def get_shard_width(self,opt,shard):
+        world_size,rank = shard
+        return (opt.W-rank+world_size-1)//world_size
+
+    def get_shard_pixel(self,opt,shard_idx,shard): # [R]
+        # map row-major indices within the columns of the shard to pixel indices
+        world_size,rank = shard
+        W_shard = self.get_shard_width(opt,shard)
+        return shard_idx//W_shard*opt.W+shard_idx%W_shard*world_size+rank
+
     def compute_loss(self,opt,var,mode=None):
         loss = edict()
         batch_size = len(var.idx)
-        image = var.image.view(batch_size,3,opt.H*opt.W).permute(0,2,1) # (batch_size, opt.H*opt.W, 3) , GT?
-
-        rendering_weight = var.prob  # (batch, H*W, 128(sample point?),1)
-        z_val = var.depth_samples
-
-        if opt.nerf.rand_rays and mode in ["train","test-optim"]:
-            image = image[:,var.ray_idx]
+        if "ray_batch" in var:
+            # the ground truth was gathered together with the rays
+            image = var.ray_batch[None,:,RAY_BANK.rgb] # [1,R,3]
+        else:
+            image = var.image.view(batch_size,3,opt.H*opt.W).permute(0,2,1) # (batch_size, opt.H*opt.W, 3) , GT?
+            if opt.nerf.rand_rays and mode in ["train","test-optim"]:
+                image = image[:,var.ray_idx]
 
         # compute image losses
+        # (rays drawn by importance sampling are reweighted so the losses stay unbiased estimates of the uniform ones)
+        ray_weight = var.get("ray_weight")
         if opt.loss_weight.render is not None:
-            loss.render = self.MSE_loss(var.rgb,image)
+            loss.render = self.MSE_loss(var.rgb,image,weight=ray_weight)
         if opt.loss_weight.render_fine is not None:
             assert(opt.nerf.fine_sampling)
-            loss.render_fine = self.MSE_loss(var.rgb_fine,image)
+            loss.render_fine = self.MSE_loss(var.rgb_fine,image,weight=ray_weight)
+        if ray_weight is not None and mode=="train":
+            rgb = var.rgb_fine if opt.nerf.fine_sampling else var.rgb
+            error = ((rgb.detach()-image)**2).mean(dim=-1)[0] # [R]
+            self.ray_sampler.update(opt,var.ray_batch[:,RAY_BANK.image_idx].long(),var.ray_batch[:,RAY_BANK.ray_idx].long(),error)
+        if opt.loss_weight.proposal is not None and opt.nerf.proposal.sample_intvs and mode=="train":
+            loss.proposal = self.compute_proposal_loss(opt,var)
 
         if opt.depth.use_depth_loss and opt.loss_weight.depth > 0:
-            pred_depth = var.depth.view(batch_size , -1,1)  #(batch , H*W, 1)
-            depth, confidence = self.get_gt_depth(opt, var, mode=mode) # [batch,H,W]
-            depth,confidence = depth.view(batch_size,-1,1),  confidence.view(batch_size,-1,1)  #(batch , H*W, 1)
-
-            if opt.nerf.rand_rays and mode in ["train","test-optim"]: #pred_depth.shape == depth.shape and
-                if pred_depth.shape[1] != var.ray_idx.shape[0]:
-                    pred_depth = pred_depth[:,var.ray_idx]
-                depth = depth[:,var.ray_idx]  #gt
-                confidence = confidence[:,var.ray_idx]
+            rendering_weight = var.prob  # (batch, H*W, 128(sample point?),1)
+            z_val = var.depth_samples
+            if "ray_batch" in var:
+                pred_depth = var.depth # [1,R,1]
+                depth = var.ray_batch[None,:,RAY_BANK.depth,None] # [1,R,1]
+                confidence = var.ray_batch[None,:,RAY_BANK.confidence,None] # [1,R,1]
+            else:
+                pred_depth = var.depth.view(batch_size , -1,1)  #(batch , H*W, 1)
+                depth, confidence = self.get_gt_depth(opt, var, mode=mode) # [batch,H,W]
+                depth,confidence = depth.view(batch_size,-1,1),  confidence.view(batch_size,-1,1)  #(batch , H*W, 1)
+
+                if opt.nerf.rand_rays and mode in ["train","test-optim"]: #pred_depth.shape == depth.shape and
+                    if pred_depth.shape[1] != var.ray_idx.shape[0]:
+                        pred_depth = pred_depth[:,var.ray_idx]
+                    depth = depth[:,var.ray_idx]  #gt
+                    confidence = confidence[:,var.ray_idx]
             loss.depth = self.compute_depth_loss(pred_depth,z_val,rendering_weight ,confidence,  depth)
         return loss
 
+    def compute_proposal_loss(self,opt,var):
+        # histogram consistency: the proposal weights should upper-bound the (fixed) weights of the main field
+        depth_bin = self.get_depth_intervals(opt,var.depth_samples).detach() # [B,HW,N+1]
+        prob = var.prob[...,0].detach() # [B,HW,N]
+        loss = 0.
+        for depth_samples_proposal,prob_proposal in zip(var.depth_samples_proposal,var.prob_proposal):
+            depth_bin_proposal = self.get_depth_intervals(opt,depth_samples_proposal) # [B,HW,Np+1]
+            prob_outer = self.get_outer_prob(depth_bin,depth_bin_proposal,prob_proposal[...,0]) # [B,HW,N]
+            loss += ((prob-prob_outer).clamp(min=0)**2/(prob+1e-7)).sum(dim=-1).mean()
+        return loss
+
+    def get_outer_prob(self,depth_bin,depth_bin_proposal,prob_proposal): # [B,HW,N+1],[B,HW,Np+1],[B,HW,Np]
+        # sum of the proposal weights over all proposal intervals overlapping each interval
+        num_bins = prob_proposal.shape[-1]
+        cdf = torch.cat([torch.zeros_like(prob_proposal[...,:1]),prob_proposal.cumsum(dim=-1)],dim=-1) # [B,HW,Np+1]
+        idx = torch.searchsorted(depth_bin_proposal.contiguous(),depth_bin.contiguous(),right=True) # [B,HW,N+1]
+        cdf_low = cdf.gather(dim=2,index=(idx[...,:-1]-1).clamp(min=0)) # [B,HW,N]
+        cdf_high = cdf.gather(dim=2,index=idx[...,1:].clamp(max=num_bins)) # [B,HW,N]
+        return cdf_high-cdf_low
+
     def get_pose(self,opt,var,mode=None):
         return var.pose
 
@@ -497,48 +711,244 @@ class Graph(base.Graph):
     def get_gt_depth(self, opt, var, mode=None):
         return var.gt_depth, var.confidence
 
-    def render(self,opt,pose,intr=None,ray_idx=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None):
-        batch_size = len(pose)
-        center,ray = camera.get_center_and_ray(opt,pose,intr=intr) # [B,HW,3]
-        while ray.isnan().any(): # TODO: weird bug, ray becomes NaN arbitrarily if batch_size>1, not deterministic reproducible
-            center,ray = camera.get_center_and_ray(opt,pose,intr=intr) # [B,HW,3]
-        if ray_idx is not None:
-            # consider only subset of rays
-            center,ray = center[:,ray_idx],ray[:,ray_idx]
+    def render(self,opt,pose,intr=None,ray_idx=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,outputs=None):
+        # outputs: names of the returned outputs (all by default), their fine counterparts are included as well
+        # consider only subset of rays if ray_idx is given
+        center,ray = camera.get_center_and_ray(opt,pose,intr=intr,ray_idx=ray_idx) # [B,HW,3]
         if opt.camera.ndc:
             # convert center/ray representations to NDC
             center,ray = camera.convert_NDC(opt,center,ray,intr=intr)
+        return self.render_rays(opt,center,ray,ray_idx=ray_idx,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far,outputs=outputs)
+
+    def render_rays(self,opt,center,ray,ray_idx=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,outputs=None): # [B,HW,3]
+        # render given rays (e.g. gathered from several cameras in render_server)
+        batch_size = len(center)
         # render with main MLP
-        depth_samples = self.sample_depth(opt,batch_size,num_rays=ray.shape[1], idx=idx,ray_idx=ray_idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,N,1] , idx : batch, ray_idx : ray num
-        rgb_samples,density_samples = self.nerf.forward_samples(opt,center,ray,depth_samples,mode=mode)
-        rgb,depth,opacity,prob = self.nerf.composite(opt,ray,rgb_samples,density_samples,depth_samples)
+        if opt.depth.use_depth and opt.depth.prior.sampling and depth is not None:
+            # draw samples from the sensor depth prior directly (replaces a coarse pass)
+            depth_samples = self.sample_depth_from_prior(opt,batch_size,ray_idx=ray_idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,N,1]
+        elif opt.depth.use_depth and opt.depth.packed_intvs and near is not None and far is not None:
+            # confident rays only need a few samples within the sensor depth bounds
+            assert(not opt.nerf.fine_sampling)
+            ret = self.render_packed(opt,self.nerf,center,ray,ray_idx=ray_idx,mode=mode,confidence=confidence,near=near,far=far)
+            return self.select_outputs(ret,outputs)
+        else:
+            depth_samples = self.sample_depth(opt,batch_size,num_rays=ray.shape[1], idx=idx,ray_idx=ray_idx,depth=depth,confidence=confidence,near=near,far=far) # [B,HW,N,1] , idx : batch, ray_idx : ray num
+        if opt.nerf.proposal.sample_intvs:
+            # resample through the proposal networks so the full field is only evaluated at the final samples
+            depth_samples,depth_samples_proposal,prob_proposal = self.sample_depth_from_proposal(opt,center,ray,depth_samples,mode=mode)
+        rgb,depth,opacity,prob = self.render_samples(opt,self.nerf,center,ray,depth_samples,mode=mode)
         ret = edict(rgb=rgb,depth=depth,opacity=opacity,prob=prob,depth_samples=depth_samples) # [B,HW,K]
+        if opt.nerf.proposal.sample_intvs and mode=="train":
+            ret.update(depth_samples_proposal=depth_samples_proposal,prob_proposal=prob_proposal)
 
         # render with fine MLP from coarse MLP
         if opt.nerf.fine_sampling:
             with torch.no_grad():
                 # resample depth acoording to coarse empirical distribution
-                depth_samples_fine = self.sample_depth_from_pdf(opt,pdf=prob[...,0]) # [B,HW,Nf,1]
-                depth_samples = torch.cat([depth_samples,depth_samples_fine],dim=2) # [B,HW,N+Nf,1]
-                depth_samples = depth_samples.sort(dim=2).values
-            rgb_samples,density_samples = self.nerf_fine.forward_samples(opt,center,ray,depth_samples,mode=mode)
-            rgb_fine,depth_fine,opacity_fine,prob_fine = self.nerf_fine.composite(opt,ray,rgb_samples,density_samples,depth_samples)
+                # (prob_i is the mass of the interval starting at coarse sample i, with the last one extending to the far bound)
+                depth_bin = self.get_depth_intervals(opt,depth_samples) # [B,HW,N+1]
+                depth_samples_fine = self.sample_depth_from_pdf(opt,pdf=prob[...,0],depth_bin=depth_bin) # [B,HW,Nf,1]
+                depth_samples = self.merge_sorted_samples(depth_samples,depth_samples_fine) # [B,HW,N+Nf,1]
+            rgb_fine,depth_fine,opacity_fine,prob_fine = self.render_samples(opt,self.nerf_fine,center,ray,depth_samples,mode=mode)
             ret.update(rgb_fine=rgb_fine,depth_fine=depth_fine,opacity_fine=opacity_fine,prob=prob) # [B,HW,K]
+        return self.select_outputs(ret,outputs)
+
+    def select_outputs(self,ret,outputs=None):
+        if outputs is None: return ret
+        # drop the references to everything else (e.g. per-sample tensors) so it is released right away
+        return edict({ k: v for k,v in ret.items() if k.replace("_fine","") in outputs })
+
+    def sample_depth_from_proposal(self,opt,center,ray,depth_samples,mode=None):
+        # the proposal networks are only trained through the proposal loss, which should not reach the (BARF) poses
+        center,ray = center.detach(),ray.detach()
+        depth_samples_proposal,prob_proposal = [],[]
+        for proposal,num_samples in zip(self.nerf_proposal,opt.nerf.proposal.sample_intvs):
+            density_samples = proposal.forward_density(opt,center,ray,depth_samples,mode=mode) # [B,HW,N]
+            prob = proposal.compute_prob(opt,ray,density_samples,depth_samples) # [B,HW,N,1]
+            depth_samples_proposal.append(depth_samples)
+            prob_proposal.append(prob)
+            with torch.no_grad():
+                depth_bin = self.get_depth_intervals(opt,depth_samples) # [B,HW,N+1]
+                depth_samples = self.sample_depth_from_pdf(opt,pdf=prob[...,0],num_samples=num_samples,depth_bin=depth_bin,
+                                                           stratified=opt.nerf.sample_stratified and mode=="train") # [B,HW,Np,1]
+        return depth_samples,depth_samples_proposal,prob_proposal
+
+    def get_depth_intervals(self,opt,depth_samples): # [B,HW,N,1]
+        # prob_i is the mass of the interval starting at sample i, with the last one extending to the far bound
+        # (the samples are metric depths, so the far bound is converted from the depth parametrization)
+        depth_far = opt.nerf.depth.range[1]
+        if opt.nerf.depth.param=="inverse":
+            depth_far = 1/depth_far if depth_far>0 else np.inf
+        depth_last = depth_samples[...,-1:,0] # [B,HW,1]
+        if np.isinf(depth_far):
+            # far bound at infinity: extend the last interval by the one before it
+            depth_end = depth_last+(depth_last-depth_samples[...,-2:-1,0])
+        else: depth_end = depth_last.clamp(min=depth_far)
+        depth_bin = torch.cat([depth_samples[...,0],depth_end],dim=2) # [B,HW,N+1]
+        return depth_bin
+
+    def render_packed(self,opt,nerf,center,ray,ray_idx=None,mode=None,confidence=None,near=None,far=None):
+        batch_size,num_rays,num_samples = *ray.shape[:2],opt.nerf.sample_intvs
+        depth_samples_packed,ray_id,valid = self.sample_depth_packed(opt,batch_size,ray_idx=ray_idx,confidence=confidence,near=near,far=far) # [S,1],[S],[BHW,N]
+        center,ray = center.reshape(-1,3),ray.reshape(-1,3) # [BHW,3]
+        rgb_samples,density_samples = self.forward_samples_packed(opt,nerf,center,ray,depth_samples_packed,ray_id,mode=mode) # [S,3],[S]
+        rgb,depth,opacity,prob = nerf.composite_packed(opt,ray,rgb_samples,density_samples,depth_samples_packed,ray_id) # [BHW,K],[S,1]
+        self.packed_ratio = len(ray_id)/valid.numel()
+        # scatter the weights back to the padded layout (padded samples have zero weight)
+        prob_padded = torch.zeros(*valid.shape,1,device=opt.device,dtype=prob.dtype) # [BHW,N,1]
+        prob_padded[valid] = prob
+        depth_samples_padded = torch.zeros(*valid.shape,1,device=opt.device) # [BHW,N,1]
+        depth_samples_padded[valid] = depth_samples_packed
+        ret = edict(rgb=rgb.view(batch_size,num_rays,3),
+                    depth=depth.view(batch_size,num_rays,1),
+                    opacity=opacity.view(batch_size,num_rays,1),
+                    prob=prob_padded.view(batch_size,num_rays,num_samples,1),
+                    depth_samples=depth_samples_padded.view(batch_size,num_rays,num_samples,1)) # [B,HW,K]
         return ret
 
-    def render_by_slices(self,opt,pose,intr=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None):
-        ret_all = edict(rgb=[],depth=[],opacity=[],prob=[],depth_samples=[])
-        if opt.nerf.fine_sampling:
-            ret_all.update(rgb_fine=[],depth_fine=[],opacity_fine=[], prob_fine = [])
-        # render the image by slices for memory considerations
-        for c in range(0,opt.H*opt.W,opt.nerf.rand_rays):
-            ray_idx = torch.arange(c,min(c+opt.nerf.rand_rays,opt.H*opt.W),device=opt.device)
-            ret = self.render(opt,pose,intr=intr,ray_idx=ray_idx,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far) # [B,R,3],[B,R,1]
-            for k in ret: ret_all[k].append(ret[k])
-        # group all slices of images
-        for k in ret_all: ret_all[k] = torch.cat(ret_all[k],dim=1)
+    def forward_samples_packed(self,opt,nerf,center,ray,depth_samples,ray_id,mode=None):
+        points_3D_samples = center[ray_id]+ray[ray_id]*depth_samples # [S,3]
+        if opt.nerf.occ_grid.res:
+            occupied = self.occ_grid.query(opt,points_3D_samples) # [S]
+            self.occ_grid.skip_ratio = 1-occupied.float().mean() # (kept on the device, read when logging)
+            points_3D_samples,ray_id = points_3D_samples[occupied],ray_id[occupied] # [M,3],[M]
+        feat_samples,density_samples = nerf.forward_feat(opt,points_3D_samples,mode=mode) # [M,K],[M]
+        if opt.nerf.view_dep:
+            ray_unit = torch_F.normalize(ray,dim=-1) # [BHW,3]
+            view_bias = nerf.get_view_bias(opt,ray_unit)[ray_id] # [M,K]
+        else: view_bias = None
+        rgb_samples = nerf.forward_rgb(opt,feat_samples,view_bias=view_bias) # [M,3]
+        if opt.nerf.occ_grid.res:
+            rgb_all = torch.zeros(len(occupied),3,device=opt.device,dtype=rgb_samples.dtype)
+            density_all = torch.zeros(len(occupied),device=opt.device,dtype=density_samples.dtype)
+            rgb_all[occupied],density_all[occupied] = rgb_samples,density_samples
+            rgb_samples,density_samples = rgb_all,density_all
+        return rgb_samples,density_samples # [S,3],[S]
+
+    def render_samples(self,opt,nerf,center,ray,depth_samples,mode=None):
+        if opt.nerf.early_term.thres and mode not in ["train","test-optim"]:
+            return self.composite_front_to_back(opt,nerf,center,ray,depth_samples,mode=mode)
+        if opt.nerf.deferred_rgb.thres and mode!="train":
+            return self.composite_deferred(opt,nerf,center,ray,depth_samples,mode=mode)
+        rgb_samples,density_samples = self.forward_samples(opt,nerf,center,ray,depth_samples,mode=mode)
+        rgb,depth,opacity,prob = nerf.composite(opt,ray,rgb_samples,density_samples,depth_samples)
+        return rgb,depth,opacity,prob # [B,HW,K]
+
+    def composite_deferred(self,opt,nerf,center,ray,depth_samples,mode=None):
+        # first pass: run only the density trunk to get the sample weights
+        points_3D_samples = camera.get_3D_points_from_depth(opt,center,ray,depth_samples,multi_samples=True) # [B,HW,N,3]
+        if opt.nerf.occ_grid.res:
+            occupied = self.occ_grid.query(opt,points_3D_samples) # [B,HW,N]
+            self.occ_grid.skip_ratio = 1-occupied.float().mean()
+        else: occupied = torch.ones_like(points_3D_samples[...,0],dtype=torch.bool) # [B,HW,N]
+        feat_occ,density_occ = nerf.forward_feat(opt,points_3D_samples[occupied],mode=mode) # [M,K],[M]
+        density_samples = torch.zeros_like(points_3D_samples[...,0],dtype=density_occ.dtype) # [B,HW,N]
+        density_samples[occupied] = density_occ
+        prob = nerf.compute_prob(opt,ray,density_samples,depth_samples) # [B,HW,N,1]
+        # second pass: run the RGB head only for samples with significant weights
+        keep = prob[...,0].detach()>opt.nerf.deferred_rgb.thres # [B,HW,N]
+        keep &= occupied
+        self.rgb_keep_ratio = keep.float().mean() # (kept on the device, read when logging)
+        if opt.nerf.view_dep:
+            ray_unit = torch_F.normalize(ray,dim=-1) # [B,HW,3]
+            view_bias = nerf.get_view_bias(opt,ray_unit)[...,None,:] # [B,HW,1,K]
+            view_bias = view_bias.expand(*keep.shape,-1)[keep] # [M',K]
+        else: view_bias = None
+        rgb_keep = nerf.forward_rgb(opt,feat_occ[keep[occupied]],view_bias=view_bias) # [M',3]
+        rgb_samples = torch.zeros_like(points_3D_samples,dtype=rgb_keep.dtype) # [B,HW,N,3]
+        rgb_samples[keep] = rgb_keep
+        rgb,depth,opacity,prob = nerf.composite(opt,ray,rgb_samples,density_samples,depth_samples)
+        return rgb,depth,opacity,prob # [B,HW,K]
+
+    @torch.no_grad()
+    def composite_front_to_back(self,opt,nerf,center,ray,depth_samples,mode=None):
+        # evaluate the samples in chunks along the ray and stop querying rays whose transmittance vanished
+        batch_size,num_rays,num_samples = depth_samples.shape[:3]
+        center,ray = center.reshape(-1,3),ray.reshape(-1,3) # [BHW,3]
+        depth_samples = depth_samples.reshape(-1,num_samples,1) # [BHW,N,1]
+        ray_length = ray.norm(dim=-1,keepdim=True) # [BHW,1]
+        depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [BHW,N-1]
+        depth_intv_samples = torch.cat([depth_intv_samples,torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)],dim=1) # [BHW,N]
+        dist_samples = depth_intv_samples*ray_length # [BHW,N]
+        T = torch.ones(len(ray),device=opt.device) # [BHW]
+        prob = torch.zeros_like(depth_samples) # [BHW,N,1]
+        rgb = torch.zeros_like(ray) # [BHW,3]
+        active = torch.ones(len(ray),dtype=torch.bool,device=opt.device) # [BHW]
+        for c in range(0,num_samples,opt.nerf.early_term.chunk):
+            ray_act = active.nonzero()[:,0] # [M]
+            if not len(ray_act): break
+            depth_chunk = depth_samples[ray_act,c:c+opt.nerf.early_term.chunk] # [M,K,1]
+            rgb_chunk,density_chunk = self.forward_samples(opt,nerf,center[None,ray_act],ray[None,ray_act],depth_chunk[None],mode=mode) # [1,M,K,3],[1,M,K]
+            sigma_delta = density_chunk[0]*dist_samples[ray_act,c:c+opt.nerf.early_term.chunk] # [M,K]
+            alpha = 1-(-sigma_delta).exp_() # [M,K]
+            T_chunk = T[ray_act,None]*(-torch.cat([torch.zeros_like(sigma_delta[...,:1]),sigma_delta[...,:-1]],dim=1).cumsum(dim=1)).exp_() # [M,K]
+            prob_chunk = (T_chunk*alpha)[...,None] # [M,K,1]
+            prob[ray_act,c:c+opt.nerf.early_term.chunk] = prob_chunk
+            rgb[ray_act] += (rgb_chunk[0]*prob_chunk).sum(dim=1)
+            T[ray_act] = T_chunk[:,-1]*(1-alpha[:,-1])
+            active &= T>opt.nerf.early_term.thres
+        # integrate depth weighted by probability
+        depth = (depth_samples*prob).sum(dim=1) # [BHW,1]
+        opacity = prob.sum(dim=1) # [BHW,1]
+        if opt.nerf.setbg_opaque:
+            rgb = rgb+opt.data.bgcolor*(1-opacity)
+        rgb,depth,opacity = rgb.view(batch_size,num_rays,3),depth.view(batch_size,num_rays,1),opacity.view(batch_size,num_rays,1)
+        prob = prob.view(batch_size,num_rays,num_samples,1)
+        return rgb,depth,opacity,prob # [B,HW,K]
+
+    def forward_samples(self,opt,nerf,center,ray,depth_samples,mode=None):
+        if not opt.nerf.occ_grid.res:
+            return nerf.forward_samples(opt,center,ray,depth_samples,mode=mode)
+        # skip samples that fall into empty cells of the occupancy grid
+        points_3D_samples = camera.get_3D_points_from_depth(opt,center,ray,depth_samples,multi_samples=True) # [B,HW,N,3]
+        occupied = self.occ_grid.query(opt,points_3D_samples) # [B,HW,N]
+        self.occ_grid.skip_ratio = 1-occupied.float().mean()
+        if occupied.all():
+            return nerf.forward_samples(opt,center,ray,depth_samples,mode=mode)
+        feat_occ,density_occ = nerf.forward_feat(opt,points_3D_samples[occupied],mode=mode) # [M,K],[M]
+        if opt.nerf.view_dep:
+            ray_unit = torch_F.normalize(ray,dim=-1) # [B,HW,3]
+            view_bias = nerf.get_view_bias(opt,ray_unit)[...,None,:] # [B,HW,1,K]
+            view_bias = view_bias.expand(*occupied.shape,-1)[occupied] # [M,K]
+        else: view_bias = None
+        rgb_occ = nerf.forward_rgb(opt,feat_occ,view_bias=view_bias) # [M,3]
+        rgb_samples = torch.zeros_like(points_3D_samples,dtype=rgb_occ.dtype) # [B,HW,N,3]
+        density_samples = torch.zeros_like(points_3D_samples[...,0],dtype=density_occ.dtype) # [B,HW,N]
+        rgb_samples[occupied] = rgb_occ
+        density_samples[occupied] = density_occ
+        return rgb_samples,density_samples
+
+    def render_by_slices(self,opt,pose,intr=None,mode=None,idx=None,depth=None,confidence=None,near=None,far=None,outputs=("rgb","depth","opacity"),ray_range=None):
+        # the per-sample outputs (prob,depth_samples) are only gathered if asked for (e.g. for the depth loss)
+        # ray_range: render only the rays [start,end) of the image (e.g. a tile in render_pool)
+        start,end = ray_range or (0,opt.H*opt.W)
+        ret_all = edict()
+        # render the image by slices for memory considerations, writing each slice into the output directly
+        chunk = self.get_render_chunk(opt)
+        for c in range(start,end,chunk):
+            ray_idx = torch.arange(c,min(c+chunk,end),device=opt.device)
+            ret = self.render(opt,pose,intr=intr,ray_idx=ray_idx,mode=mode,idx=idx,depth=depth,confidence=confidence,near=near,far=far,outputs=outputs) # [B,R,3],[B,R,1]
+            for k in ret:
+                if k not in ret_all:
+                    ret_all[k] = torch.empty(ret[k].shape[0],end-start,*ret[k].shape[2:],device=opt.device) # [B,HW,...]
+                ret_all[k][:,c-start:c-start+len(ray_idx)] = ret[k]
         return ret_all
 
+    def get_render_chunk(self,opt):
+        # number of rays per slice when rendering full images (independent of the training batch)
+        # (slices are split over rays only, so render_rays_budget bounds the number of samples approximately:
+        #  a single ray always fits, as training evaluates rand_rays of them with gradients)
+        if opt.nerf.render_chunk: return opt.nerf.render_chunk
+        if opt.nerf.render_rays_budget: return max(opt.nerf.render_rays_budget//self.get_samples_per_ray(opt),1)
+        return opt.H*opt.W
+
+    def get_samples_per_ray(self,opt):
+        # largest number of samples per ray evaluated by a single field at once
+        if opt.nerf.proposal.sample_intvs: return max(opt.nerf.sample_intvs,*opt.nerf.proposal.sample_intvs)
+        if opt.nerf.fine_sampling: return opt.nerf.sample_intvs+opt.nerf.sample_intvs_fine
+        return opt.nerf.sample_intvs
+
     # def precompute_depth_sampling(self,opt,depth,confidence):
     #     #TODO : 지금 기준은 confidence , 성능 구리면 depth 값 기준으로도 더 조건 추가 4.5 이상이면 해보고 별로면
     #     depth_min, depth_max = opt.nerf.depth.range
@@ -708,7 +1118,7 @@ class Graph(base.Graph):
         # sample_intvs : sampling point num , idx : batch_num
         num_rays = num_rays or opt.H * opt.W
         depth_min,depth_max=opt.nerf.depth.range
-        rand_samples = torch.rand(batch_size, num_rays, opt.nerf.sample_intvs, 1, device=opt.device) if opt.nerf.sample_stratified else 0.5
+        rand_samples = self.rand_strata(opt,[batch_size,num_rays],opt.nerf.sample_intvs)[...,None] if opt.nerf.sample_stratified else 0.5
         rand_samples += torch.arange(opt.nerf.sample_intvs, device=opt.device)[None, None, :, None].float()  # [B,HW,N,1] [1,1024,128,1]
         depth_samples = rand_samples / opt.nerf.sample_intvs * (depth_max - depth_min) + depth_min  # [B,HW,N,1] [1,1024,128,1]
 
@@ -724,19 +1134,20 @@ class Graph(base.Graph):
 
 
             # half sampling with depth infor
-            rand_samples = torch.rand(batch_size, num_rays, N_samples_depth, 1,device=opt.device) if opt.nerf.sample_stratified else 0.5
+            rand_samples = self.rand_strata(opt,[batch_size,num_rays],N_samples_depth)[...,None] if opt.nerf.sample_stratified else 0.5
             rand_samples += torch.arange(N_samples_depth, device=opt.device)[None, None, :,None].float()  # [B,HW,N,1] [1,1024,64,1]
 
             near = near.view(batch_size,-1)
             far = far.view(batch_size,-1)
-            near, far = near[:,ray_idx],far[:, ray_idx]
+            if ray_idx is not None: # (rays gathered from the ray bank are already selected)
+                near, far = near[:,ray_idx],far[:, ray_idx]
             near, far = near.unsqueeze(-1), far.unsqueeze(-1)
             near, far = near.expand_as(rand_samples[...,0]),  far.expand_as(rand_samples[...,0])  #[B,H*W,N]
             near, far = near.unsqueeze(-1), far.unsqueeze(-1)  # [B,H*W,N,1]
             depth_samples1 = rand_samples / N_samples_depth * (far - near) + near  # [B,HW,N,1] [1,1024,64,1]
 
             # origin half sampling
-            rand_samples2 = torch.rand(batch_size, num_rays, N_samples_origin, 1, device=opt.device) if opt.nerf.sample_stratified else 0.5
+            rand_samples2 = self.rand_strata(opt,[batch_size,num_rays],N_samples_origin)[...,None] if opt.nerf.sample_stratified else 0.5
             rand_samples2 += torch.arange(N_samples_origin, device=opt.device)[None, None, :,None].float()  # [B,HW,N,1] [1,1024,64,1]
             depth_samples2 = rand_samples2 / N_samples_origin * (depth_max - depth_min) + depth_min  # [B,HW,N,1] [1,1024,64,1]
 
@@ -746,7 +1157,8 @@ class Graph(base.Graph):
             if not opt.depth.sampling_half_confi0:
                 # confi0 opt.nerf.sample_intvs sampling
                 confidence = confidence.view(batch_size, -1)
-                confidence = confidence[:, ray_idx]  # [1,1024]
+                if ray_idx is not None:
+                    confidence = confidence[:, ray_idx]  # [1,1024]
                 confi0 = confidence == 0
                 depth_samples_combination[confi0] = depth_samples[confi0]
             depth_samples = depth_samples_combination
@@ -763,27 +1175,104 @@ class Graph(base.Graph):
         return depth_samples
 
 
-    def sample_depth_from_pdf(self,opt,pdf):
+    def rand_strata(self,opt,shape,num_strata):
+        # jitter within each of the depth strata of every ray (drawn from the depth sampler)
+        rand = self.rng.depth.rand(int(np.prod(shape)),num_strata,device=opt.device) # [R,N]
+        return rand.view(*shape,num_strata) # [...,N]
+
+    def sample_depth_packed(self,opt,batch_size,ray_idx=None,confidence=None,near=None,far=None):
+        num_samples = opt.nerf.sample_intvs
+        num_intvs = opt.depth.packed_intvs
+        assert(num_intvs<=num_samples)
+        confidence,near,far = confidence.view(batch_size,-1),near.view(batch_size,-1),far.view(batch_size,-1)
+        if ray_idx is not None:
+            confidence,near,far = confidence[:,ray_idx],near[:,ray_idx],far[:,ray_idx] # [B,HW]
+        confidence,near,far = confidence.reshape(-1),near.reshape(-1),far.reshape(-1) # [BHW]
+        confident = confidence==2 # [BHW]
+        # stratified samples within [near,far] for confident rays
+        near_conf,far_conf = near[confident,None,None],far[confident,None,None] # [R,1,1]
+        rand_samples = self.rand_strata(opt,[len(near_conf)],num_intvs)[...,None] if opt.nerf.sample_stratified else 0.5
+        rand_samples += torch.arange(num_intvs,device=opt.device)[None,:,None].float() # [R,Nc,1]
+        depth_samples_conf = rand_samples/num_intvs*(far_conf-near_conf)+near_conf # [R,Nc,1]
+        depth_samples_conf = dict(
+            metric=depth_samples_conf,
+            inverse=1/(depth_samples_conf+1e-8),
+        )[opt.nerf.depth.param]
+        # the full set of samples (as in sample_depth) is only drawn for the other rays
+        unconfident = ~confident
+        depth_samples_unconf = self.sample_depth(opt,1,num_rays=int(unconfident.sum()),confidence=confidence[unconfident],
+                                                 near=near[unconfident],far=far[unconfident])[0] # [U,N,1]
+        # pack the samples of all rays (in ray order) with per-ray sample counts
+        num_samples_ray = torch.where(confident,num_intvs,num_samples) # [BHW]
+        valid = torch.arange(num_samples,device=opt.device)[None]<num_samples_ray[:,None] # [BHW,N]
+        ray_id = torch.arange(len(valid),device=opt.device)[:,None].expand_as(valid)[valid] # [S]
+        sample_conf = confident[ray_id] # [S]
+        depth_samples = torch.empty(len(ray_id),1,device=opt.device,dtype=depth_samples_unconf.dtype) # [S,1]
+        depth_samples[sample_conf] = depth_samples_conf.reshape(-1,1).to(depth_samples.dtype)
+        depth_samples[~sample_conf] = depth_samples_unconf.reshape(-1,1)
+        return depth_samples,ray_id,valid # [S,1],[S],[BHW,N]
+
+    def sample_depth_from_prior(self,opt,batch_size,ray_idx=None,depth=None,confidence=None,near=None,far=None):
+        # analytic PDF around the sensor depth: truncated Gaussian (spanning [near,far]) mixed with a uniform floor
+        assert(opt.nerf.depth.param=="metric" and not opt.nerf.fine_sampling)
         depth_min,depth_max = opt.nerf.depth.range
+        depth,confidence = depth.view(batch_size,-1),confidence.view(batch_size,-1)
+        near,far = near.view(batch_size,-1),far.view(batch_size,-1)
+        if ray_idx is not None:
+            depth,confidence,near,far = depth[:,ray_idx],confidence[:,ray_idx],near[:,ray_idx],far[:,ray_idx] # [B,HW]
+        depth,near,far = depth[...,None].float(),near[...,None].float(),far[...,None].float() # [B,HW,1]
+        depth_bin = torch.linspace(depth_min,depth_max,opt.depth.prior.bins+1,device=opt.device) # [M+1]
+        std = ((far-near)/(2*opt.depth.prior.num_std)).clamp(min=1e-3) # [B,HW,1]
+        cdf_gauss = 0.5*(1+torch.erf((depth_bin-depth)/(std*np.sqrt(2)))) # [B,HW,M+1]
+        pdf_gauss = cdf_gauss[...,1:]-cdf_gauss[...,:-1] # [B,HW,M]
+        pdf_gauss = pdf_gauss/(pdf_gauss.sum(dim=-1,keepdim=True)+1e-8)
+        floor = torch.tensor(opt.depth.prior.floor,device=opt.device)[confidence.long()][...,None] # [B,HW,1]
+        pdf = (1-floor)*pdf_gauss+floor/opt.depth.prior.bins # [B,HW,M]
+        pdf = pdf/pdf.sum(dim=-1,keepdim=True)
+        depth_samples = self.sample_depth_from_pdf(opt,pdf=pdf,num_samples=opt.nerf.sample_intvs,stratified=opt.nerf.sample_stratified) # [B,HW,N,1]
+        return depth_samples
+
+    def sample_depth_from_pdf(self,opt,pdf,num_samples=None,stratified=False,depth_bin=None):
+        depth_min,depth_max = opt.nerf.depth.range
+        num_bins = pdf.shape[-1]
+        num_samples = num_samples or opt.nerf.sample_intvs_fine
         # get CDF from PDF (along last dimension)
+        # the CDF is normalized so that rays with opacity below 1 are resampled over their full range as well
+        # (a small floor keeps it well defined for empty rays)
+        pdf = pdf+1e-5/num_bins
         cdf = pdf.cumsum(dim=-1) # [B,HW,N]
+        cdf = cdf/cdf[...,-1:]
         cdf = torch.cat([torch.zeros_like(cdf[...,:1]),cdf],dim=-1) # [B,HW,N+1]
         # take uniform samples
-        grid = torch.linspace(0,1,opt.nerf.sample_intvs_fine+1,device=opt.device) # [Nf+1]
-        unif = 0.5*(grid[:-1]+grid[1:]).repeat(*cdf.shape[:-1],1) # [B,HW,Nf]
+        grid = torch.linspace(0,1,num_samples+1,device=opt.device) # [Nf+1]
+        if stratified:
+            unif = grid[:-1]+self.rand_strata(opt,cdf.shape[:-1],num_samples)/num_samples # [B,HW,Nf]
+        else: unif = 0.5*(grid[:-1]+grid[1:]).repeat(*cdf.shape[:-1],1) # [B,HW,Nf]
         idx = torch.searchsorted(cdf,unif,right=True) # [B,HW,Nf] \in {1...N}
         # inverse transform sampling from CDF
-        depth_bin = torch.linspace(depth_min,depth_max,opt.nerf.sample_intvs+1,device=opt.device) # [N+1]
-        depth_bin = depth_bin.repeat(*cdf.shape[:-1],1) # [B,HW,N+1]
+        if depth_bin is None:
+            depth_bin = torch.linspace(depth_min,depth_max,num_bins+1,device=opt.device) # [N+1]
+            depth_bin = depth_bin.repeat(*cdf.shape[:-1],1) # [B,HW,N+1]
         depth_low = depth_bin.gather(dim=2,index=(idx-1).clamp(min=0)) # [B,HW,Nf]
-        depth_high = depth_bin.gather(dim=2,index=idx.clamp(max=opt.nerf.sample_intvs)) # [B,HW,Nf]
+        depth_high = depth_bin.gather(dim=2,index=idx.clamp(max=num_bins)) # [B,HW,Nf]
         cdf_low = cdf.gather(dim=2,index=(idx-1).clamp(min=0)) # [B,HW,Nf]
-        cdf_high = cdf.gather(dim=2,index=idx.clamp(max=opt.nerf.sample_intvs)) # [B,HW,Nf]
+        cdf_high = cdf.gather(dim=2,index=idx.clamp(max=num_bins)) # [B,HW,Nf]
         # linear interpolation
         t = (unif-cdf_low)/(cdf_high-cdf_low+1e-8) # [B,HW,Nf]
         depth_samples = depth_low+t*(depth_high-depth_low) # [B,HW,Nf]
         return depth_samples[...,None] # [B,HW,Nf,1]
 
+    def merge_sorted_samples(self,depth_samples,depth_samples_fine): # [B,HW,N,1],[B,HW,Nf,1]
+        # both sets are already sorted, so the merged position of each sample is its own index plus its rank in the other set
+        depth_coarse,depth_fine = depth_samples[...,0].contiguous(),depth_samples_fine[...,0].contiguous() # [B,HW,N],[B,HW,Nf]
+        N,Nf = depth_coarse.shape[-1],depth_fine.shape[-1]
+        idx_coarse = torch.arange(N,device=depth_coarse.device)+torch.searchsorted(depth_fine,depth_coarse,right=False) # [B,HW,N]
+        idx_fine = torch.arange(Nf,device=depth_fine.device)+torch.searchsorted(depth_coarse,depth_fine,right=True) # [B,HW,Nf]
+        depth_merged = torch.empty(*depth_coarse.shape[:-1],N+Nf,device=depth_coarse.device) # [B,HW,N+Nf]
+        depth_merged.scatter_(2,idx_coarse,depth_coarse)
+        depth_merged.scatter_(2,idx_fine,depth_fine)
+        return depth_merged[...,None] # [B,HW,N+Nf,1]
+
 class NeRF(torch.nn.Module):
 
     def __init__(self,opt):
@@ -791,7 +1280,10 @@ class NeRF(torch.nn.Module):
         self.define_network(opt)
 
     def define_network(self,opt):
-        input_3D_dim = 3+6*opt.arch.posenc.L_3D if opt.arch.posenc else 3
+        if opt.arch.encoding=="hashgrid":
+            self.hash_grid = HashGridEncoding(opt)
+            input_3D_dim = 3+opt.arch.hashgrid.levels*opt.arch.hashgrid.feat_dim
+        else: input_3D_dim = 3+6*opt.arch.posenc.L_3D if opt.arch.posenc else 3
         if opt.nerf.view_dep:
             input_view_dim = 3+6*opt.arch.posenc.L_view if opt.arch.posenc else 3
         # point-wise feature
@@ -829,10 +1321,12 @@ class NeRF(torch.nn.Module):
         torch.nn.init.zeros_(linear.bias)
 
     def forward(self,opt,points_3D,ray_unit=None,mode=None): # [B,...,3]
-        if opt.arch.posenc:
-            points_enc = self.positional_encoding(opt,points_3D,L=opt.arch.posenc.L_3D)
-            points_enc = torch.cat([points_3D,points_enc],dim=-1) # [B,...,6L+3]
-        else: points_enc = points_3D
+        feat,density = self.forward_feat(opt,points_3D,mode=mode)
+        rgb = self.forward_rgb(opt,feat,ray_unit=ray_unit)
+        return rgb,density
+
+    def forward_feat(self,opt,points_3D,mode=None): # [B,...,3]
+        points_enc = self.encode_points(opt,points_3D)
         feat = points_enc
         # extract coordinate-based features
         for li,layer in enumerate(self.mlp_feat):
@@ -846,31 +1340,101 @@ class NeRF(torch.nn.Module):
                 density = density_activ(density)
                 feat = feat[...,1:]
             feat = torch_F.relu(feat)
-        # predict RGB values
-        if opt.nerf.view_dep:
+        return feat,density # [B,...,K],[B,...]
+
+    def forward_rgb(self,opt,feat,ray_unit=None,view_bias=None): # [B,...,K]
+        # view_bias: precomputed contribution of the viewpoint to the first RGB layer (see get_view_bias())
+        if opt.nerf.view_dep and view_bias is None:
             assert(ray_unit is not None)
-            if opt.arch.posenc:
-                ray_enc = self.positional_encoding(opt,ray_unit,L=opt.arch.posenc.L_view)
-                ray_enc = torch.cat([ray_unit,ray_enc],dim=-1) # [B,...,6L+3]
-            else: ray_enc = ray_unit
+            ray_enc = self.encode_view(opt,ray_unit)
             feat = torch.cat([feat,ray_enc],dim=-1)
+        # predict RGB values
         for li,layer in enumerate(self.mlp_rgb):
-            feat = layer(feat)
+            if li==0 and view_bias is not None:
+                feat = torch_F.linear(feat,layer.weight[:,:feat.shape[-1]])+view_bias
+            else: feat = layer(feat)
             if li!=len(self.mlp_rgb)-1:
                 feat = torch_F.relu(feat)
         rgb = feat.sigmoid_() # [B,...,3]
-        return rgb,density
+        return rgb
+
+    def encode_points(self,opt,points_3D): # [B,...,3]
+        if opt.arch.encoding=="hashgrid":
+            level_weight = self.get_c2f_weight(opt,L=opt.arch.hashgrid.levels)
+            points_enc = self.hash_grid(opt,points_3D,level_weight=level_weight)
+            points_enc = torch.cat([points_3D,points_enc],dim=-1) # [B,...,LF+3]
+        elif opt.arch.posenc:
+            points_enc = self.positional_encoding(opt,points_3D,L=opt.arch.posenc.L_3D)
+            points_enc = torch.cat([points_3D,points_enc],dim=-1) # [B,...,6L+3]
+        else: points_enc = points_3D
+        return points_enc
+
+    def encode_view(self,opt,ray_unit): # [B,...,3]
+        if opt.arch.posenc:
+            ray_enc = self.positional_encoding(opt,ray_unit,L=opt.arch.posenc.L_view)
+            ray_enc = torch.cat([ray_unit,ray_enc],dim=-1) # [B,...,6L+3]
+        else: ray_enc = ray_unit
+        return ray_enc
+
+    def get_view_bias(self,opt,ray_unit): # [B,HW,3]
+        # the first RGB layer is linear in [feat,ray_enc], so the viewpoint term can be computed once per ray
+        ray_enc = self.encode_view(opt,ray_unit) # [B,HW,6L+3]
+        layer = self.mlp_rgb[0]
+        view_bias = torch_F.linear(ray_enc,layer.weight[:,-ray_enc.shape[-1]:],layer.bias) # [B,HW,K]
+        return view_bias
 
     def forward_samples(self,opt,center,ray,depth_samples,mode=None):
         points_3D_samples = camera.get_3D_points_from_depth(opt,center,ray,depth_samples,multi_samples=True) # [B,HW,N,3]
+        feat_samples,density_samples = self.forward_feat(opt,points_3D_samples,mode=mode) # [B,HW,N,K],[B,HW,N]
         if opt.nerf.view_dep:
             ray_unit = torch_F.normalize(ray,dim=-1) # [B,HW,3]
-            ray_unit_samples = ray_unit[...,None,:].expand_as(points_3D_samples) # [B,HW,N,3]
-        else: ray_unit_samples = None
-        rgb_samples,density_samples = self.forward(opt,points_3D_samples,ray_unit=ray_unit_samples,mode=mode) # [B,HW,N],[B,HW,N,3]
+            view_bias = self.get_view_bias(opt,ray_unit)[...,None,:] # [B,HW,1,K]
+        else: view_bias = None
+        rgb_samples = self.forward_rgb(opt,feat_samples,view_bias=view_bias) # [B,HW,N,3]
         return rgb_samples,density_samples
 
     def composite(self,opt,ray,rgb_samples,density_samples,depth_samples):
+        if opt.nerf.fused_composite:
+            # same quadrature, but only the inputs are kept for backward (transmittance is recomputed)
+            ray_length = ray.norm(dim=-1,keepdim=True) # [B,HW,1]
+            rgb,depth,opacity,prob = VolumeRendering.apply(rgb_samples,density_samples,depth_samples,ray_length)
+        else:
+            prob = self.compute_prob(opt,ray,density_samples,depth_samples) # [B,HW,N,1]
+            # integrate RGB and depth weighted by probability
+            depth = (depth_samples*prob).sum(dim=2) # [B,HW,1]
+            rgb = (rgb_samples*prob).sum(dim=2) # [B,HW,3]
+            opacity = prob.sum(dim=2) # [B,HW,1]
+        if opt.nerf.setbg_opaque:
+            rgb = rgb+opt.data.bgcolor*(1-opacity)
+        return rgb,depth,opacity,prob # [B,HW,K]
+
+    def composite_packed(self,opt,ray,rgb_samples,density_samples,depth_samples,ray_id):
+        # volume rendering over packed samples, where consecutive samples with the same ray_id form a ray segment
+        ray_length = ray.norm(dim=-1)[ray_id] # [S]
+        last = torch.ones_like(ray_id,dtype=torch.bool) # [S]
+        last[:-1] = ray_id[1:]!=ray_id[:-1]
+        depth_intv_samples = torch.cat([depth_samples[1:,0]-depth_samples[:-1,0],torch.empty_like(depth_samples[:1,0])]) # [S]
+        depth_intv_samples = depth_intv_samples.masked_fill(last,1e10)
+        dist_samples = depth_intv_samples*ray_length # [S]
+        sigma_delta = density_samples*dist_samples # [S]
+        alpha = 1-(-sigma_delta).exp_() # [S]
+        # exclusive cumulative sum within each segment (in double precision as the sum runs across all rays)
+        sigma_delta_cum = sigma_delta.masked_fill(last,0).double().cumsum(dim=0) # [S]
+        sigma_delta_excl = torch.cat([torch.zeros_like(sigma_delta_cum[:1]),sigma_delta_cum[:-1]]) # [S]
+        first = torch.cat([torch.ones_like(last[:1]),last[:-1]]) # [S]
+        segment_start = sigma_delta_excl[first] # [BHW]
+        T = (-(sigma_delta_excl-segment_start[ray_id]).float()).exp_() # [S]
+        prob = (T*alpha)[...,None] # [S,1]
+        # integrate RGB and depth weighted by probability
+        num_rays = len(ray)
+        depth = torch.zeros(num_rays,1,device=opt.device).index_add_(0,ray_id,depth_samples*prob) # [BHW,1]
+        rgb = torch.zeros(num_rays,3,device=opt.device).index_add_(0,ray_id,rgb_samples*prob) # [BHW,3]
+        opacity = torch.zeros(num_rays,1,device=opt.device).index_add_(0,ray_id,prob) # [BHW,1]
+        if opt.nerf.setbg_opaque:
+            rgb = rgb+opt.data.bgcolor*(1-opacity)
+        return rgb,depth,opacity,prob # [BHW,K],[S,1]
+
+    def compute_prob(self,opt,ray,density_samples,depth_samples):
         ray_length = ray.norm(dim=-1,keepdim=True) # [B,HW,1]
         # volume rendering: compute probability (using quadrature)
         depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [B,HW,N-1]
@@ -880,13 +1444,11 @@ class NeRF(torch.nn.Module):
         alpha = 1-(-sigma_delta).exp_() # [B,HW,N]
         T = (-torch.cat([torch.zeros_like(sigma_delta[...,:1]),sigma_delta[...,:-1]],dim=2).cumsum(dim=2)).exp_() # [B,HW,N]
         prob = (T*alpha)[...,None] # [B,HW,N,1]
-        # integrate RGB and depth weighted by probability
-        depth = (depth_samples*prob).sum(dim=2) # [B,HW,1]
-        rgb = (rgb_samples*prob).sum(dim=2) # [B,HW,3]
-        opacity = prob.sum(dim=2) # [B,HW,1]
-        if opt.nerf.setbg_opaque:
-            rgb = rgb+opt.data.bgcolor*(1-opacity)
-        return rgb,depth,opacity,prob # [B,HW,K]
+        return prob
+
+    def get_c2f_weight(self,opt,L):
+        # weights of the frequency bands/resolution levels (all bands are used by default)
+        return None
 
     def positional_encoding(self,opt,input,L): # [B,...,N]
         shape = input.shape
@@ -896,3 +1458,213 @@ class NeRF(torch.nn.Module):
         input_enc = torch.stack([sin,cos],dim=-2) # [B,...,N,2,L]
         input_enc = input_enc.view(*shape[:-1],-1) # [B,...,2NL]
         return input_enc
+
+class ProposalNeRF(NeRF):
+
+    def define_network(self,opt):
+        # small density-only MLP that produces the sampling PDF for the main field
+        input_3D_dim = 3+6*opt.nerf.proposal.L_3D
+        self.mlp_feat = torch.nn.ModuleList()
+        L = util.get_layer_dims(opt.nerf.proposal.layers)
+        for li,(k_in,k_out) in enumerate(L):
+            if li==0: k_in = input_3D_dim
+            if li==len(L)-1: k_out = 1
+            linear = torch.nn.Linear(k_in,k_out)
+            if opt.arch.tf_init:
+                self.tensorflow_init_weights(opt,linear,out="all" if li==len(L)-1 else None)
+            self.mlp_feat.append(linear)
+
+    def forward_density(self,opt,center,ray,depth_samples,mode=None):
+        points_3D_samples = camera.get_3D_points_from_depth(opt,center,ray,depth_samples,multi_samples=True) # [B,HW,N,3]
+        points_enc = self.positional_encoding(opt,points_3D_samples,L=opt.nerf.proposal.L_3D)
+        feat = torch.cat([points_3D_samples,points_enc],dim=-1) # [B,HW,N,6L+3]
+        for li,layer in enumerate(self.mlp_feat):
+            feat = layer(feat)
+            if li!=len(self.mlp_feat)-1:
+                feat = torch_F.relu(feat)
+        density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
+        density = density_activ(feat[...,0])
+        return density # [B,HW,N]
+
+class VolumeRendering(torch.autograd.Function):
+
+    @staticmethod
+    def compute_prob(density_samples,depth_samples,ray_length):
+        depth_intv_samples = depth_samples[...,1:,0]-depth_samples[...,:-1,0] # [B,HW,N-1]
+        depth_intv_samples = torch.cat([depth_intv_samples,torch.empty_like(depth_intv_samples[...,:1]).fill_(1e10)],dim=2) # [B,HW,N]
+        sigma_delta = density_samples*depth_intv_samples*ray_length # [B,HW,N]
+        T = (-torch.cat([torch.zeros_like(sigma_delta[...,:1]),sigma_delta],dim=2).cumsum(dim=2)).exp_() # [B,HW,N+1]
+        prob = T[...,:-1]-T[...,1:] # [B,HW,N] (T_i*alpha_i)
+        return prob,T,depth_intv_samples
+
+    @staticmethod
+    def forward(ctx,rgb_samples,density_samples,depth_samples,ray_length): # [B,HW,N,3],[B,HW,N],[B,HW,N,1],[B,HW,1]
+        prob,_,_ = VolumeRendering.compute_prob(density_samples,depth_samples,ray_length) # [B,HW,N]
+        prob = prob[...,None] # [B,HW,N,1]
+        rgb = (rgb_samples*prob).sum(dim=2) # [B,HW,3]
+        depth = (depth_samples*prob).sum(dim=2) # [B,HW,1]
+        opacity = prob.sum(dim=2) # [B,HW,1]
+        ctx.save_for_backward(rgb_samples,density_samples,depth_samples,ray_length)
+        return rgb,depth,opacity,prob
+
+    @staticmethod
+    def backward(ctx,grad_rgb,grad_depth,grad_opacity,grad_prob): # [B,HW,3],[B,HW,1],[B,HW,1],[B,HW,N,1]
+        rgb_samples,density_samples,depth_samples,ray_length = ctx.saved_tensors
+        prob,T,depth_intv_samples = VolumeRendering.compute_prob(density_samples,depth_samples,ray_length)
+        # total gradient w.r.t. the probability of each sample
+        grad_prob = grad_prob[...,0]+(grad_rgb[...,None,:]*rgb_samples).sum(dim=-1)+grad_depth*depth_samples[...,0]+grad_opacity # [B,HW,N]
+        # d(prob_i)/d(sigma_delta_k) = T_{k+1} if i==k, -prob_i if i>k
+        grad_prob_weighted = grad_prob*prob # [B,HW,N]
+        grad_suffix = grad_prob_weighted.sum(dim=2,keepdim=True)-grad_prob_weighted.cumsum(dim=2) # [B,HW,N]
+        grad_sigma_delta = grad_prob*T[...,1:]-grad_suffix # [B,HW,N]
+        grad_rgb_samples = grad_density_samples = grad_depth_samples = grad_ray_length = None
+        if ctx.needs_input_grad[0]:
+            grad_rgb_samples = grad_rgb[...,None,:]*prob[...,None] # [B,HW,N,3]
+        if ctx.needs_input_grad[1]:
+            grad_density_samples = grad_sigma_delta*depth_intv_samples*ray_length # [B,HW,N]
+        if ctx.needs_input_grad[2]:
+            grad_intv = grad_sigma_delta[...,:-1]*density_samples[...,:-1]*ray_length # [B,HW,N-1]
+            grad_depth_samples = grad_depth*prob # [B,HW,N]
+            grad_depth_samples[...,1:] += grad_intv
+            grad_depth_samples[...,:-1] -= grad_intv
+            grad_depth_samples = grad_depth_samples[...,None] # [B,HW,N,1]
+        if ctx.needs_input_grad[3]:
+            grad_ray_length = (grad_sigma_delta*density_samples*depth_intv_samples).sum(dim=2,keepdim=True) # [B,HW,1]
+        return grad_rgb_samples,grad_density_samples,grad_depth_samples,grad_ray_length
+
+class HashGridEncoding(torch.nn.Module):
+
+    def __init__(self,opt):
+        super().__init__()
+        levels,feat_dim = opt.arch.hashgrid.levels,opt.arch.hashgrid.feat_dim
+        res_min,res_max = opt.arch.hashgrid.res
+        self.table_size = 2**opt.arch.hashgrid.log2_size
+        # resolutions grow geometrically from the coarsest to the finest level
+        growth = np.exp((np.log(res_max)-np.log(res_min))/max(levels-1,1))
+        self.res = [int(np.floor(res_min*growth**l)) for l in range(levels)]
+        self.tables = torch.nn.Parameter(torch.empty(levels,self.table_size,feat_dim).uniform_(-1e-4,1e-4))
+        corners = [[i,j,k] for i in (0,1) for j in (0,1) for k in (0,1)]
+        self.register_buffer("corners",torch.tensor(corners),persistent=False) # [8,3]
+
+    def forward(self,opt,points_3D,level_weight=None): # [B,...,3]
+        range_min,range_max = opt.arch.hashgrid.range
+        shape = points_3D.shape
+        points_unit = ((points_3D.reshape(-1,3)-range_min)/(range_max-range_min)).clamp(min=0,max=1) # [P,3]
+        feat_all = []
+        for l,res in enumerate(self.res):
+            points_grid = points_unit*res # [P,3]
+            points_floor = points_grid.detach().floor().clamp_(max=res-1)
+            frac = points_grid-points_floor # [P,3]
+            vertex = points_floor.long()[:,None]+self.corners # [P,8,3]
+            # trilinear interpolation of the features at the 8 cell corners
+            weight = torch.where(self.corners.bool(),frac[:,None],1-frac[:,None]).prod(dim=-1) # [P,8]
+            feat = (self.tables[l][self.hash_index(vertex,res)]*weight[...,None]).sum(dim=1) # [P,F]
+            feat_all.append(feat)
+        feat_all = torch.stack(feat_all,dim=1) # [P,L,F]
+        if level_weight is not None:
+            feat_all = feat_all*level_weight[:,None]
+        return feat_all.view(*shape[:-1],-1) # [B,...,LF]
+
+    def hash_index(self,vertex,res): # [P,8,3]
+        if (res+1)**3<=self.table_size:
+            # coarse levels fit into the table and are indexed densely
+            return vertex[...,0]+vertex[...,1]*(res+1)+vertex[...,2]*(res+1)**2
+        index = vertex[...,0]^(vertex[...,1]*2654435761)^(vertex[...,2]*805459861)
+        return index%self.table_size # [P,8]
+
+class ErrorSampler(torch.nn.Module):
+
+    def __init__(self,opt,num_images):
+        super().__init__()
+        tile = opt.nerf.importance.tile
+        self.grid_H,self.grid_W = (opt.H+tile-1)//tile,(opt.W+tile-1)//tile
+        # use a buffer so the error estimates could be checkpointed (initialized high so that every tile gets visited)
+        self.register_buffer("error",torch.ones(num_images,self.grid_H*self.grid_W))
+        tile_H = (opt.H-torch.arange(self.grid_H)*tile).clamp_(max=tile) # [Gh] (the last row/column might be cropped)
+        tile_W = (opt.W-torch.arange(self.grid_W)*tile).clamp_(max=tile) # [Gw]
+        self.register_buffer("tile_H",tile_H,persistent=False)
+        self.register_buffer("tile_W",tile_W,persistent=False)
+        self.register_buffer("tile_size",(tile_H[:,None]*tile_W[None]).view(-1).float(),persistent=False) # [T]
+
+    def get_shard_columns(self,opt,shard):
+        # first column and number of columns of each tile within the image columns x%world_size==rank
+        world_size,rank = shard
+        x_start = torch.arange(self.grid_W,device=self.tile_W.device)*opt.nerf.importance.tile # [Gw]
+        x_first = x_start+(rank-x_start)%world_size # [Gw]
+        shard_W = ((x_start+self.tile_W-x_first+world_size-1)//world_size).clamp_(min=0) # [Gw]
+        return x_first,shard_W
+
+    @torch.no_grad()
+    def sample(self,opt,idx,num_rays,shard=(1,0)): # [B]
+        # draw tiles of the given images proportionally to their (per-pixel) running error mixed with a uniform floor
+        # and the pixels uniformly within each tile, returns the importance weights w.r.t. uniform sampling
+        # (only the pixels of the shard are drawn, so that the weights match the rendered pixels in data-parallel training)
+        tile,floor = opt.nerf.importance.tile,opt.nerf.importance.floor
+        x_first,shard_W = self.get_shard_columns(opt,shard) # [Gw]
+        tile_size = (self.tile_H[:,None]*shard_W[None]).view(-1).float() # [T]
+        num_pixels = len(idx)*tile_size.sum()
+        error_mass = self.error[idx]*tile_size # [B,T]
+        prob = (1-floor)*error_mass/error_mass.sum()+floor*tile_size/num_pixels # [B,T]
+        cell = torch.multinomial(prob.view(-1),num_rays,replacement=True) # [R]
+        image_idx,tile_idx = cell//len(tile_size),cell%len(tile_size) # [R]
+        tile_y,tile_x = tile_idx//self.grid_W,tile_idx%self.grid_W # [R]
+        y = tile_y*tile+(torch.rand(num_rays,device=cell.device)*self.tile_H[tile_y]).long() # [R]
+        x = x_first[tile_x]+(torch.rand(num_rays,device=cell.device)*shard_W[tile_x]).long()*shard[0] # [R]
+        ray_weight = tile_size[tile_idx]/(num_pixels*prob.view(-1)[cell]) # [R]
+        return image_idx,y*opt.W+x,ray_weight
+
+    @torch.no_grad()
+    def update(self,opt,image_idx,ray_idx,error): # [R]
+        # exponential moving average of the mean error of each visited tile
+        tile = opt.nerf.importance.tile
+        tile_idx = (ray_idx//opt.W//tile)*self.grid_W+ray_idx%opt.W//tile # [R]
+        cell,inverse = (image_idx*len(self.tile_size)+tile_idx).unique(return_inverse=True) # [C],[R]
+        error_sum = torch.zeros(len(cell),device=error.device).index_add_(0,inverse,error) # [C]
+        count = torch.zeros(len(cell),device=error.device).index_add_(0,inverse,torch.ones_like(error)) # [C]
+        error_cell = self.error.view(-1)[cell]
+        decay = opt.nerf.importance.decay
+        self.error.view(-1)[cell] = decay*error_cell+(1-decay)*error_sum/count
+
+class OccupancyGrid(torch.nn.Module):
+
+    def __init__(self,opt):
+        super().__init__()
+        res = opt.nerf.occ_grid.res
+        # use buffers so the grid could be checkpointed (all cells are occupied until the first update)
+        self.register_buffer("density",torch.full([res,res,res],np.inf))
+        self.register_buffer("occupied",torch.ones(res,res,res,dtype=torch.bool))
+        self.skip_ratio = 0.
+
+    def get_cell_index(self,opt,points_3D): # [B,...,3]
+        range_min,range_max = opt.nerf.occ_grid.range
+        res = opt.nerf.occ_grid.res
+        coord = ((points_3D-range_min)/(range_max-range_min)*res).floor_().long() # [B,...,3]
+        inside = ((coord>=0)&(coord<res)).all(dim=-1) # [B,...]
+        coord = coord.clamp_(min=0,max=res-1)
+        return coord,inside
+
+    @torch.no_grad()
+    def query(self,opt,points_3D): # [B,...,3]
+        coord,inside = self.get_cell_index(opt,points_3D)
+        occupied = self.occupied[coord[...,0],coord[...,1],coord[...,2]] # [B,...]
+        # samples outside of the grid are conservatively considered occupied
+        return occupied|~inside
+
+    @torch.no_grad()
+    def update(self,opt,nerf,chunk_size):
+        range_min,range_max = opt.nerf.occ_grid.range
+        res = opt.nerf.occ_grid.res
+        # evaluate volume density at a jittered location inside every cell
+        cell = torch.arange(res,device=opt.device)
+        cell = torch.stack(torch.meshgrid(cell,cell,cell),dim=-1).view(-1,3) # [R^3,3]
+        density_new = []
+        for c in range(0,len(cell),chunk_size):
+            points_3D = (cell[c:c+chunk_size]+torch.rand(len(cell[c:c+chunk_size]),3,device=opt.device))/res
+            points_3D = points_3D*(range_max-range_min)+range_min # [C,3]
+            _,density = nerf.forward_feat(opt,points_3D[None],mode=None) # [1,C]
+            density_new.append(density[0])
+        density_new = torch.cat(density_new,dim=0).view(res,res,res)
+        # keep a decaying running maximum so cells are not emptied by a single unlucky jitter
+        density = torch.where(self.density.isinf(),density_new,self.density*opt.nerf.occ_grid.decay)
+        self.density.copy_(torch.max(density,density_new))
+        self.occupied.copy_(self.density>opt.nerf.occ_grid.thres)
@@ -0,0 +1,96 @@
+import numpy as np
+import os,sys,time
+import torch
+import torch.nn.functional as torch_F
+from easydict import EasyDict as edict
+
+import util
+from util import log,debug
+from . import nerf
+
+# ============================ tensor-decomposition (VM) radiance field ============================
+
+class TensoRF(nerf.NeRF):
+
+    def __init__(self,opt):
+        super().__init__(opt)
+        self.progress = torch.nn.Parameter(torch.tensor(0.)) # use Parameter so it could be checkpointed (shared interface with BARF)
+
+    def define_network(self,opt):
+        # each component is the product of a plane (over 2 axes) and a line (over the remaining axis)
+        self.mat_mode = [[0,1],[0,2],[1,2]]
+        self.vec_mode = [2,1,0]
+        res = opt.arch.tensorf.res[0]
+        self.density_plane,self.density_line = self.init_VM(opt.arch.tensorf.comp_density,res)
+        self.app_plane,self.app_line = self.init_VM(opt.arch.tensorf.comp_app,res)
+        self.basis_mat = torch.nn.Linear(sum(opt.arch.tensorf.comp_app),opt.arch.tensorf.app_dim,bias=False)
+        # RGB prediction (same layout as the MLP NeRF so the view-dependent factorization is shared)
+        if opt.nerf.view_dep:
+            input_view_dim = 3+6*opt.arch.posenc.L_view if opt.arch.posenc else 3
+        self.mlp_rgb = torch.nn.ModuleList()
+        L = util.get_layer_dims(opt.arch.layers_rgb)
+        for li,(k_in,k_out) in enumerate(L):
+            if li==0: k_in = opt.arch.tensorf.app_dim+(input_view_dim if opt.nerf.view_dep else 0)
+            linear = torch.nn.Linear(k_in,k_out)
+            if opt.arch.tf_init:
+                self.tensorflow_init_weights(opt,linear,out="all" if li==len(L)-1 else None)
+            self.mlp_rgb.append(linear)
+
+    def init_VM(self,num_comp,res,scale=0.1):
+        plane = torch.nn.ParameterList([torch.nn.Parameter(scale*torch.randn(1,num_comp[i],res,res)) for i in range(3)])
+        line = torch.nn.ParameterList([torch.nn.Parameter(scale*torch.randn(1,num_comp[i],res,1)) for i in range(3)])
+        return plane,line
+
+    def grid_parameters(self):
+        return [*self.density_plane,*self.density_line,*self.app_plane,*self.app_line]
+
+    def mlp_parameters(self):
+        return [*self.basis_mat.parameters(),*self.mlp_rgb.parameters(),self.progress]
+
+    def forward_feat(self,opt,points_3D,mode=None): # [B,...,3]
+        range_min,range_max = opt.arch.tensorf.range
+        shape = points_3D.shape
+        points_norm = (points_3D.reshape(-1,3)-range_min)/(range_max-range_min)*2-1 # [P,3]
+        # volume density from the sum of all density components
+        density = torch.cat(self.compute_VM(points_norm,self.density_plane,self.density_line),dim=0).sum(dim=0) # [P]
+        density = density+opt.arch.tensorf.density_shift
+        if opt.nerf.density_noise_reg and mode=="train":
+            density += torch.randn_like(density)*opt.nerf.density_noise_reg
+        density_activ = getattr(torch_F,opt.arch.density_activ) # relu_,abs_,sigmoid_,exp_....
+        density = density_activ(density)
+        # appearance features projected by the basis matrix
+        feat = torch.cat(self.compute_VM(points_norm,self.app_plane,self.app_line),dim=0) # [C,P]
+        feat = self.basis_mat(feat.t()) # [P,K]
+        return feat.view(*shape[:-1],-1),density.view(*shape[:-1]) # [B,...,K],[B,...]
+
+    def compute_VM(self,points_norm,plane,line): # [P,3]
+        feat = []
+        for i in range(3):
+            coord_plane = points_norm[:,self.mat_mode[i]].view(1,-1,1,2) # [1,P,1,2]
+            coord_line = torch.stack([torch.zeros_like(points_norm[:,0]),points_norm[:,self.vec_mode[i]]],dim=-1).view(1,-1,1,2) # [1,P,1,2]
+            feat_plane = torch_F.grid_sample(plane[i],coord_plane,align_corners=True)[0,:,:,0] # [C,P]
+            feat_line = torch_F.grid_sample(line[i],coord_line,align_corners=True)[0,:,:,0] # [C,P]
+            feat.append(feat_plane*feat_line)
+        return feat
+
+    def get_upsample_res(self,opt,it):
+        # grid resolutions grow geometrically at each upsampling iteration
+        res_init,res_final = opt.arch.tensorf.res
+        num_steps = len(opt.arch.tensorf.upsample_iters)
+        res_all = np.exp(np.linspace(np.log(res_init),np.log(res_final),num_steps+1))[1:]
+        return int(res_all[opt.arch.tensorf.upsample_iters.index(it)])
+
+    @torch.no_grad()
+    def upsample(self,opt,res):
+        for plane,line in [(self.density_plane,self.density_line),(self.app_plane,self.app_line)]:
+            for i in range(3):
+                plane[i].data = torch_F.interpolate(plane[i].data,size=(res,res),mode="bilinear",align_corners=True)
+                line[i].data = torch_F.interpolate(line[i].data,size=(res,1),mode="bilinear",align_corners=True)
+
+    def _load_from_state_dict(self,state_dict,prefix,*args,**kwargs):
+        # the grids might have been upsampled, so match their sizes to the checkpoint first
+        for name,param in self.named_parameters():
+            key = prefix+name
+            if key in state_dict and state_dict[key].shape!=param.shape:
+                param.data = torch.empty_like(state_dict[key],device=param.device)
+        super()._load_from_state_dict(state_dict,prefix,*args,**kwargs)
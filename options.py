@@ -4,6 +4,7 @@ import torch
 import random
 import string
 import yaml
+import socket
 from easydict import EasyDict as edict
 
 import util
@@ -45,12 +46,29 @@ def set(opt_cmd={}):
     assert("yaml" in opt_cmd)
     fname = "options/{}.yaml".format(opt_cmd.yaml)
     opt_base = load_options(fname)
+    # merge per-machine settings (e.g. chunk sizes written by autotune.py)
+    profile = opt_cmd.get("profile",opt_base.profile)
+    if profile:
+        profile_fname = get_profile_fname(opt_cmd.yaml)
+        if os.path.isfile(profile_fname):
+            with open(profile_fname) as file:
+                opt_profile = edict(yaml.safe_load(file))
+            if profile!="train":
+                # the number of training rays changes the results, so it is only taken with --profile=train
+                opt_profile.get("nerf",{}).pop("rand_rays",None)
+            for group,values in opt_profile.items():
+                for key,value in values.items():
+                    log.warning("{0}.{1}={2} (from {3})".format(group,key,value,profile_fname))
+            opt_base = override_options(opt_base,opt_profile,key_stack=[])
     # override with command line arguments
     opt = override_options(opt_base,opt_cmd,key_stack=[],safe_check=True)
     process_options(opt)
     log.options(opt)
     return opt
 
+def get_profile_fname(yaml_name):
+    return "options/profiles/{0}/{1}.yaml".format(socket.gethostname(),yaml_name)
+
 def load_options(fname):
     with open(fname) as file:
         opt = edict(yaml.safe_load(file))
@@ -85,6 +103,13 @@ def override_options(opt,opt_over,key_stack=None,safe_check=False):
     return opt
 
 def process_options(opt):
+    # data-parallel training with one process per rank (launched with torchrun, see train.py)
+    opt.world_size = int(os.environ.get("WORLD_SIZE",1))
+    opt.rank = int(os.environ.get("RANK",0))
+    if opt.world_size>1:
+        assert(opt.seed is not None) # all ranks must agree on the run name and the initialization
+        # sparse gradients (optim.sparse_pose) can only be all-reduced with gloo
+        assert(opt.dist.backend=="gloo" or not opt.optim.get("sparse_pose")),"optim.sparse_pose needs dist.backend=gloo"
     # set seed
     if opt.seed is not None:
         random.seed(opt.seed)
@@ -100,8 +125,8 @@ def process_options(opt):
     # other default options
     opt.output_path = "{0}/{1}/{2}".format(opt.output_root,opt.group,opt.name)
     os.makedirs(opt.output_path,exist_ok=True)  # ouput 폴더 만든다 .
-    assert(isinstance(opt.gpu,int)) # disable multi-GPU support for now, single is enough
-    opt.device = "cpu" if opt.cpu or not torch.cuda.is_available() else "cuda:{}".format(opt.gpu)
+    assert(isinstance(opt.gpu,int)) # a single device per process (one GPU per local rank for data-parallel training)
+    opt.device = "cpu" if opt.cpu or not torch.cuda.is_available() else "cuda:{}".format(opt.gpu+int(os.environ.get("LOCAL_RANK",0)))
     opt.H,opt.W = opt.data.image_size
 
 def save_options_file(opt):
@@ -0,0 +1,59 @@
+import numpy as np
+import os,sys,time
+import collections
+import torch
+import torch.multiprocessing as mp
+import tqdm
+from easydict import EasyDict as edict
+
+# ============================ multi-process rendering of full frames (CPU) ============================
+
+worker = edict() # per-process state (set once when the worker starts)
+
+def init_worker(opt,graph,num_threads):
+    # the graph is inherited from the parent (fork) and its weights live in shared memory
+    torch.set_num_threads(num_threads)
+    worker.update(opt=opt,graph=graph)
+
+@torch.no_grad()
+def render_tile(task):
+    frame,ray_range,mode,outputs = task
+    ret = worker.graph.render_by_slices(worker.opt,**frame,mode=mode,outputs=outputs,ray_range=ray_range) # [B,R,K]
+    return edict(ret)
+
+class RenderPool():
+
+    def __init__(self,opt,graph):
+        self.opt = opt
+        num_workers = opt.render_pool.workers
+        num_threads = max(torch.get_num_threads()//num_workers,1)
+        graph.share_memory()
+        self.pool = mp.get_context("fork").Pool(num_workers,initializer=init_worker,initargs=(opt,graph,num_threads))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.pool.close()
+        self.pool.join()
+
+    def render(self,frames,mode=None,outputs=("rgb","depth","opacity"),desc=None):
+        # frames: iterable of dicts with the keyword arguments of render_by_slices() (pose,intr,idx,depth,...)
+        # each frame is split into tiles, and the frames are yielded in order as soon as all their tiles are done
+        # (up to one frame per worker is in flight so that all workers stay busy, a generator is only advanced that far ahead)
+        opt = self.opt
+        bounds = np.linspace(0,opt.H*opt.W,opt.render_pool.tiles+1).astype(int)
+        ray_ranges = [(start,end) for start,end in zip(bounds[:-1],bounds[1:]) if end>start]
+        progress = tqdm.tqdm(total=len(frames) if isinstance(frames,list) else None,desc=desc,leave=False)
+        frames = iter(frames)
+        pending = collections.deque()
+        while True:
+            while len(pending)<opt.render_pool.workers:
+                frame = next(frames,None)
+                if frame is None: break
+                pending.append([self.pool.apply_async(render_tile,((frame,ray_range,mode,outputs),)) for ray_range in ray_ranges])
+            if not pending: break
+            tiles = [t.get() for t in pending.popleft()]
+            progress.update()
+            yield edict({ k: torch.cat([t[k] for t in tiles],dim=1) for k in tiles[0] }) # [B,HW,K]
+        progress.close()
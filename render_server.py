@@ -0,0 +1,189 @@
+"""Serves renderings of a trained model over HTTP, coalescing concurrent requests into shared ray batches."""
+
+import numpy as np
+import os,sys,time
+import torch
+import torchvision.transforms.functional as torchvision_F
+import importlib
+import io,json,queue,threading
+import http.server
+from easydict import EasyDict as edict
+
+import options
+import camera
+from util import log
+
+# python3 render_server.py --group=strayscanner --model=barf --yaml=barf_strayscanner --name=statue_2 --data.scene=statue --resume
+#
+# POST /render with a JSON body:
+#     pose: 3x4 camera pose (world-to-camera, in the coordinate system of the trained model)
+#     intr: 3x3 intrinsic matrix
+#     H,W: image size (optional, defaults to data.image_size, H*W at most render_server.max_rays)
+#     outputs: list of rgb/depth/opacity (optional, defaults to [rgb])
+#     format: png (first output as an image) or npz (all outputs as [H,W,K] arrays)
+# GET / returns the default image size and the available outputs
+
+class RenderServer():
+
+    def __init__(self,opt,graph):
+        self.opt = opt
+        self.graph = graph
+        self.queue = queue.Queue()
+
+    def submit(self,request):
+        # called from the HTTP threads, blocks until the request has been rendered
+        request.done = threading.Event()
+        self.queue.put(request)
+        request.done.wait()
+        if "error" in request: raise request.error
+        return request.result
+
+    def run(self):
+        request_next = None
+        while True:
+            # coalesce the pending requests into one batch of at most max_rays rays
+            # (a request that would exceed it starts the next batch, each request alone fits as checked in parse_request)
+            requests = [request_next if request_next is not None else self.queue.get()]
+            num_rays = requests[0].H*requests[0].W
+            request_next = None
+            while True:
+                try: request = self.queue.get_nowait()
+                except queue.Empty: break
+                if num_rays+request.H*request.W>self.opt.render_server.max_rays:
+                    request_next = request
+                    break
+                requests.append(request)
+                num_rays += request.H*request.W
+            try:
+                self.render_batch(requests)
+            except Exception as error:
+                for request in requests: request.error = error
+            for request in requests: request.done.set()
+
+    @torch.no_grad()
+    def render_batch(self,requests):
+        opt = self.opt
+        # gather the rays of all requests
+        center_all,ray_all = [],[]
+        for request in requests:
+            opt_request = edict(opt,H=request.H,W=request.W)
+            pose,intr = request.pose[None],request.intr[None] # [1,3,4],[1,3,3]
+            center,ray = camera.get_center_and_ray(opt_request,pose,intr=intr) # [1,HW,3]
+            if opt.camera.ndc:
+                center,ray = camera.convert_NDC(opt_request,center,ray,intr=intr)
+            center_all.append(center)
+            ray_all.append(ray)
+        center,ray = torch.cat(center_all,dim=1),torch.cat(ray_all,dim=1) # [1,R,3]
+        outputs = set(k for request in requests for k in request.outputs)
+        # render in slices
+        ret_all = edict()
+        chunk = self.graph.get_render_chunk(opt)
+        for c in range(0,ray.shape[1],chunk):
+            ret = self.graph.render_rays(opt,center[:,c:c+chunk],ray[:,c:c+chunk],mode="eval",outputs=outputs) # [1,R,K]
+            for k in ret:
+                if k not in ret_all:
+                    ret_all[k] = torch.empty(1,ray.shape[1],ret[k].shape[-1],device=opt.device) # [1,R,K]
+                ret_all[k][:,c:c+ret[k].shape[1]] = ret[k]
+        # split back into the requests
+        start = 0
+        for request in requests:
+            end = start+request.H*request.W
+            request.result = edict({ k: v[0,start:end].view(request.H,request.W,-1).cpu() for k,v in ret_all.items()
+                                     if k.replace("_fine","") in request.outputs }) # [H,W,K]
+            start = end
+
+def encode_result(opt,request,result,eps=1e-10):
+    file = io.BytesIO()
+    if request.format=="npz":
+        np.savez(file,**{ k: v.numpy() for k,v in result.items() })
+        return file.getvalue(),"application/octet-stream"
+    key = request.outputs[0]
+    image = result[key]
+    if key=="depth":
+        image = (1-image)/result.opacity if opt.camera.ndc else 1/(image/result.opacity+eps)
+    torchvision_F.to_pil_image(image.clamp(0,1).permute(2,0,1)).save(file,format="PNG")
+    return file.getvalue(),"image/png"
+
+def parse_request(opt,body):
+    # malformed requests are rejected here (400), before they can be batched with other requests
+    request = edict(json.loads(body))
+    request.pose = torch.tensor(request.pose,dtype=torch.float32,device=opt.device) # [3,4]
+    request.intr = torch.tensor(request.intr,dtype=torch.float32,device=opt.device) # [3,3]
+    assert request.pose.shape==(3,4) and request.intr.shape==(3,3),"pose must be 3x4 and intr 3x3"
+    assert request.pose.isfinite().all() and request.intr.isfinite().all(),"pose and intr must be finite"
+    assert request.intr.det().abs()>0,"intr must be invertible"
+    request.H = int(request.get("H",opt.H))
+    request.W = int(request.get("W",opt.W))
+    assert 0<request.H*request.W<=opt.render_server.max_rays and request.H>0,\
+        "H and W must be positive with H*W at most {}".format(opt.render_server.max_rays)
+    request.outputs = list(request.get("outputs",["rgb"]))
+    request.format = request.get("format","png")
+    assert(set(request.outputs)<={"rgb","depth","opacity"} and request.format in ["png","npz"])
+    if request.format=="png" and request.outputs[0]=="depth": request.outputs.append("opacity")
+    return request
+
+def get_handler(opt,server):
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            info = dict(H=opt.H,W=opt.W,outputs=["rgb","depth","opacity"])
+            self.reply(200,json.dumps(info).encode(),"application/json")
+
+        def do_POST(self):
+            if self.path!="/render":
+                self.reply(404,b"not found","text/plain")
+                return
+            try:
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                request = parse_request(opt,body)
+            except Exception as error:
+                self.reply(400,str(error).encode(),"text/plain")
+                return
+            try:
+                result = server.submit(request)
+                data,content_type = encode_result(opt,request,result)
+            except Exception as error:
+                self.reply(500,str(error).encode(),"text/plain")
+                return
+            self.reply(200,data,content_type)
+
+        def reply(self,code,data,content_type):
+            self.send_response(code)
+            self.send_header("Content-Type",content_type)
+            self.send_header("Content-Length",str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self,format,*args):
+            pass
+
+    return Handler
+
+def main():
+
+    log.process(os.getpid())
+    log.title("[{}] (render server for NeRF/BARF)".format(sys.argv[0]))
+
+    opt_cmd = options.parse_arguments(sys.argv[1:])
+    opt = options.set(opt_cmd=opt_cmd)
+
+    with torch.cuda.device(opt.device):
+
+        model = importlib.import_module("model.{}".format(opt.model))
+        m = model.Model(opt)
+        # the training set is only needed to size the per-view parameters (e.g. BARF pose refinements)
+        data = importlib.import_module("data.{}".format(opt.data.dataset))
+        m.train_data = data.Dataset(opt,split="train",subset=opt.data.train_sub)
+        m.build_networks(opt)
+        m.restore_checkpoint(opt)
+        m.graph.eval()
+
+        server = RenderServer(opt,m.graph)
+        httpd = http.server.ThreadingHTTPServer((opt.render_server.host,opt.render_server.port),get_handler(opt,server))
+        threading.Thread(target=httpd.serve_forever,daemon=True).start()
+        log.info("serving on http://{0}:{1}".format(opt.render_server.host,opt.render_server.port))
+        server.run() # render in the main thread (holding the CUDA device context)
+
+if __name__=="__main__":
+    main()
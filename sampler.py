@@ -0,0 +1,79 @@
+import numpy as np
+import torch
+
+# ============================ (quasi-)random point generators for ray and depth sampling ============================
+
+def get_sampler(opt,name):
+    # the error-driven importance sampler draws its rays itself (see nerf.ErrorSampler), so its jitter is uniform
+    return dict(
+        uniform=UniformSampler,
+        importance=UniformSampler,
+        sobol=SobolSampler,
+        halton=HaltonSampler,
+    )[name](opt)
+
+def get_pixel_index(opt,points,W=None): # [R,2]
+    # map points in [0,1)^2 to pixel indices (row-major, over the first W columns if given)
+    W = W or opt.W
+    y = (points[:,0]*opt.H).long().clamp_(max=opt.H-1)
+    x = (points[:,1]*W).long().clamp_(max=W-1)
+    return y*W+x # [R]
+
+def get_primes(num):
+    primes = []
+    n = 2
+    while len(primes)<num:
+        if all(n%p for p in primes if p*p<=n): primes.append(n)
+        n += 1
+    return primes
+
+class UniformSampler():
+    # draws points in [0,1)^D; the low-discrepancy samplers are re-scrambled at every step with a seed derived from
+    # the iteration number, so a resumed run draws the same points as an uninterrupted one
+
+    def __init__(self,opt):
+        self.seed = (opt.seed or 0)+opt.rank # (different points on each rank of data-parallel training)
+        self.set_step(0)
+
+    def set_step(self,step):
+        self.step = step
+        self.count = 0
+
+    def get_seed(self):
+        # distinct seed for every draw within a step
+        self.count += 1
+        return (self.seed*1000003+self.step*1009+self.count)%2**31
+
+    def rand(self,num,dim,device=None):
+        return torch.rand(num,dim,device=device) # [num,dim]
+
+class SobolSampler(UniformSampler):
+
+    def rand(self,num,dim,device=None):
+        engine = torch.quasirandom.SobolEngine(dim,scramble=True,seed=self.get_seed())
+        return engine.draw(num).to(device) # [num,dim]
+
+class HaltonSampler(UniformSampler):
+
+    def __init__(self,opt):
+        super().__init__(opt)
+        self.primes = torch.tensor(get_primes(opt.nerf.sample_intvs+3))
+
+    def rand(self,num,dim,device=None):
+        # radical inverses with a random permutation of the digits in each base (decorrelates the higher dimensions)
+        generator = torch.Generator().manual_seed(self.get_seed())
+        if dim>len(self.primes): self.primes = torch.tensor(get_primes(dim))
+        base = self.primes[:dim] # [D]
+        rand = torch.rand(dim,int(base.max()),generator=generator) # [D,maxB]
+        rand[torch.arange(rand.shape[1])[None]>=base[:,None]] = 2 # keep the permutations within each base
+        perm = rand.argsort(dim=-1) # [D,maxB]
+        index = torch.arange(1,num+1)[:,None].expand(-1,dim).clone() # [num,D]
+        points = torch.zeros(num,dim,dtype=torch.float64)
+        scale = 1./base.double() # [D]
+        num_digits = int(np.ceil(np.log(num+1)/np.log(2)))+1
+        for _ in range(num_digits):
+            digit = index%base # [num,D]
+            points += perm.gather(dim=1,index=digit.t()).t().double()*scale
+            index = index//base
+            scale = scale/base
+        return points.float().to(device) # [num,dim]
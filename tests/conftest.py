@@ -0,0 +1,16 @@
+import os,sys
+import pytest
+
+# the scripts and yaml paths are relative to the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0,ROOT)
+
+@pytest.fixture
+def get_opt(tmp_path,monkeypatch):
+    # options as in train.py (with the outputs in a temporary directory and no per-machine profile)
+    import options
+    monkeypatch.chdir(ROOT)
+    def get_opt(*args):
+        opt_cmd = options.parse_arguments(["--output_root={}".format(tmp_path),"--profile!",*args])
+        return options.set(opt_cmd=opt_cmd)
+    return get_opt
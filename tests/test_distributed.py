@@ -0,0 +1,53 @@
+import torch
+import torch.multiprocessing as mp
+from easydict import EasyDict as edict
+
+import util
+from model import nerf
+
+def run_rank(rank,world_size,init_fname):
+    torch.distributed.init_process_group("gloo",init_method="file://{}".format(init_fname),rank=rank,world_size=world_size)
+    opt = edict(world_size=world_size,rank=rank)
+    # different initialization and data on each rank
+    torch.manual_seed(rank)
+    module = torch.nn.ModuleDict(dict(mlp=torch.nn.Sequential(torch.nn.Linear(4,8),torch.nn.ReLU(),torch.nn.Linear(8,1)),
+                                      embedding=torch.nn.Embedding(5,3,sparse=True)))
+    util.broadcast_module(module)
+    points = torch.randn(16,4)
+    idx = torch.randint(5,(3,))
+    loss = module.mlp(points).pow(2).mean()+module.embedding(idx).pow(2).sum()
+    loss.backward()
+    grads_local = [p.grad.to_dense() for p in module.parameters()]
+    util.all_reduce_grads(opt,module.parameters())
+    # the reduced gradients are the mean of the local ones
+    for p,grad_local in zip(module.parameters(),grads_local):
+        grads_all = [torch.empty_like(grad_local) for _ in range(world_size)]
+        torch.distributed.all_gather(grads_all,grad_local)
+        assert torch.allclose(p.grad.to_dense(),torch.stack(grads_all).mean(dim=0),atol=1e-6)
+    # after a step, the weights are identical on all ranks
+    torch.optim.SGD(module.parameters(),lr=0.1).step()
+    for p in module.parameters():
+        params_all = [torch.empty_like(p.data) for _ in range(world_size)]
+        torch.distributed.all_gather(params_all,p.data)
+        for params in params_all: assert torch.equal(params,p.data)
+    torch.distributed.destroy_process_group()
+
+def test_gradient_averaging_two_ranks(tmp_path):
+    mp.spawn(run_rank,args=(2,str(tmp_path/"init")),nprocs=2)
+
+def test_ray_shards_partition_pixels(get_opt):
+    opt = get_opt("--model=nerf","--yaml=nerf_blender","--data.image_size=[5,7]","--nerf.importance.tile=3")
+    graph = nerf.Graph(opt)
+    sampler = nerf.ErrorSampler(opt,num_images=2)
+    for world_size in [1,2,3]:
+        pixels_all = []
+        for rank in range(world_size):
+            shard = graph.get_shard(edict(opt,world_size=world_size,rank=rank),mode="train")
+            pixels = graph.get_shard_pixel(opt,torch.arange(opt.H*graph.get_shard_width(opt,shard)),shard)
+            assert (pixels%opt.W%world_size==rank).all()
+            pixels_all.append(pixels)
+            # importance sampling draws within the shard, with weights w.r.t. uniform sampling over the shard
+            _,ray_idx,ray_weight = sampler.sample(opt,torch.arange(2),1000,shard=shard)
+            assert (ray_idx%opt.W%world_size==rank).all()
+            assert torch.allclose(ray_weight,torch.ones_like(ray_weight)) # (the error estimates are still uniform)
+        assert torch.equal(torch.cat(pixels_all).sort().values,torch.arange(opt.H*opt.W))
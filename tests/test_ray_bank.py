@@ -0,0 +1,75 @@
+import torch
+from easydict import EasyDict as edict
+
+import camera
+import util
+from model import nerf
+from model.nerf import RAY_BANK
+
+def get_opt_ray_bank(get_opt):
+    return get_opt("--model=nerf","--yaml=barf_strayscanner","--data.image_size=[6,8]","--nerf.sample_intvs=16",
+                   "--nerf.sample_stratified!","--nerf.rand_rays=32","--nerf.ray_bank","--loss_weight.depth=1")
+
+def get_data(opt,num_images=3):
+    # random training views with sensor depth (as in train_data.all)
+    torch.manual_seed(0)
+    rot = torch.linalg.qr(torch.randn(num_images,3,3))[0] # [N,3,3]
+    pose = torch.cat([rot,torch.randn(num_images,3,1)],dim=-1) # [N,3,4]
+    intr = torch.zeros(num_images,3,3)
+    intr[:,0,0] = intr[:,1,1] = torch.rand(num_images)*10+10
+    intr[:,0,2],intr[:,1,2],intr[:,2,2] = opt.W/2,opt.H/2,1
+    gt_near = torch.rand(num_images,opt.H,opt.W)+1
+    gt_far = gt_near+torch.rand(num_images,opt.H,opt.W)+0.5
+    var = edict(idx=torch.arange(num_images),image=torch.rand(num_images,3,opt.H,opt.W),pose=pose,intr=intr,
+                gt_depth=(gt_near+gt_far)/2,confidence=torch.randint(3,(num_images,opt.H,opt.W)).float(),
+                gt_near=gt_near,gt_far=gt_far)
+    return util.move_to_device(var,opt.device)
+
+def get_model(opt):
+    # (the LPIPS network of Model.__init__ is only needed for evaluation)
+    m = nerf.Model.__new__(nerf.Model)
+    m.graph = nerf.Graph(opt).to(opt.device)
+    return m
+
+def test_ray_bank_matches_per_image_data(get_opt):
+    opt = get_opt_ray_bank(get_opt)
+    m = get_model(opt)
+    var = get_data(opt)
+    N,HW = len(var.idx),opt.H*opt.W
+    ray_bank = m.build_ray_bank(opt,var)
+    image_idx = torch.randint(N,(64,),device=opt.device)
+    ray_idx = torch.randint(HW,(64,),device=opt.device)
+    ray_batch = ray_bank[var.idx[image_idx]*HW+ray_idx] # [R,K]
+    assert torch.equal(ray_batch[:,RAY_BANK.rgb],var.image.view(N,3,HW)[image_idx,:,ray_idx])
+    for key,value in zip(["depth","confidence","near","far"],[var.gt_depth,var.confidence,var.gt_near,var.gt_far]):
+        assert torch.equal(ray_batch[:,RAY_BANK[key]],value.view(N,HW)[image_idx,ray_idx])
+    assert torch.equal(ray_batch[:,RAY_BANK.image_idx].long(),image_idx)
+    assert torch.equal(ray_batch[:,RAY_BANK.ray_idx].long(),ray_idx)
+    # rays of individual pixels vs. the full per-image rays
+    center,ray = camera.get_center_and_ray_per_pixel(opt,var.pose,var.intr,image_idx,ray_idx) # [1,R,3]
+    center_ref,ray_ref = camera.get_center_and_ray(opt,var.pose,intr=var.intr) # [N,HW,3]
+    assert torch.allclose(center[0],center_ref[image_idx,ray_idx],atol=1e-6)
+    assert torch.allclose(ray[0],ray_ref[image_idx,ray_idx],atol=1e-6)
+
+def test_ray_bank_forward_matches_per_image_render(get_opt):
+    with torch.no_grad():
+        opt = get_opt_ray_bank(get_opt)
+        m = get_model(opt)
+        var = get_data(opt)
+        N,HW = len(var.idx),opt.H*opt.W
+        var_bank = edict(var,ray_bank=m.build_ray_bank(opt,var))
+        var_bank = m.graph.forward(opt,var_bank,mode="train")
+        image_idx = var_bank.ray_batch[:,RAY_BANK.image_idx].long() # [R]
+        ray_idx = var_bank.ray_batch[:,RAY_BANK.ray_idx].long() # [R]
+        # render the same pixels through the per-image path
+        for i in image_idx.unique():
+            mask = image_idx==i
+            ret = m.graph.render(opt,var.pose[i:i+1],intr=var.intr[i:i+1],ray_idx=ray_idx[mask],mode="train",idx=var.idx[i:i+1],
+                                 depth=var.gt_depth[i:i+1],confidence=var.confidence[i:i+1],near=var.gt_near[i:i+1],far=var.gt_far[i:i+1])
+            assert torch.allclose(var_bank.rgb[0,mask],ret.rgb[0],atol=1e-5)
+            assert torch.allclose(var_bank.depth[0,mask],ret.depth[0],atol=1e-4)
+        # the losses take the ground truth from the gathered rows
+        loss = m.graph.compute_loss(opt,var_bank,mode="train")
+        image = var.image.view(N,3,HW)[image_idx,:,ray_idx] # [R,3]
+        assert torch.allclose(loss.render,((var_bank.rgb[0]-image)**2).mean())
+        assert torch.isfinite(loss.depth)
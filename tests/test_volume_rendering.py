@@ -0,0 +1,33 @@
+import torch
+
+from model.nerf import NeRF,VolumeRendering
+
+def get_inputs(B=2,R=16,N=32):
+    torch.manual_seed(0)
+    rgb_samples = torch.rand(B,R,N,3,dtype=torch.float64) # [B,R,N,3]
+    density_samples = torch.rand(B,R,N,dtype=torch.float64)*4 # [B,R,N]
+    depth_samples = torch.rand(B,R,N,1,dtype=torch.float64).sort(dim=2)[0]*4+2 # [B,R,N,1]
+    ray_length = torch.rand(B,R,1,dtype=torch.float64)+0.5 # [B,R,1]
+    return [x.requires_grad_() for x in (rgb_samples,density_samples,depth_samples,ray_length)]
+
+def test_fused_composite_matches_autograd(get_opt):
+    opt = get_opt("--model=nerf","--yaml=nerf_blender","--nerf.fused_composite!","--nerf.setbg_opaque!")
+    nerf = NeRF(opt).double()
+    inputs = get_inputs()
+    rgb_samples,density_samples,depth_samples,ray_length = inputs
+    torch.manual_seed(1)
+    ray_unit = torch.nn.functional.normalize(torch.randn(*ray_length.shape[:2],3,dtype=torch.float64),dim=-1) # [B,R,3]
+    outputs_ref = nerf.composite(opt,ray_unit*ray_length,rgb_samples,density_samples,depth_samples)
+    outputs = VolumeRendering.apply(rgb_samples,density_samples,depth_samples,ray_length)
+    # backpropagate the same random weighting of all outputs (rgb,depth,opacity,prob) through both
+    weights = [torch.randn_like(x) for x in outputs_ref]
+    grads_ref = torch.autograd.grad(sum((w*x).sum() for w,x in zip(weights,outputs_ref)),inputs)
+    grads = torch.autograd.grad(sum((w*x).sum() for w,x in zip(weights,outputs)),inputs)
+    for x,x_ref in zip(outputs,outputs_ref):
+        assert torch.allclose(x,x_ref)
+    for g,g_ref in zip(grads,grads_ref):
+        assert torch.allclose(g,g_ref)
+
+def test_fused_composite_gradcheck():
+    inputs = get_inputs(B=1,R=3,N=8)
+    assert torch.autograd.gradcheck(VolumeRendering.apply,inputs)
@@ -1,9 +1,11 @@
 import numpy as np
 import os,sys,time
+import datetime
 import torch
 import importlib
 
 import options
+import util
 from util import log
 os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
 # os.environ["CUDA_VISIBLE_DEVICES"] = "0"
@@ -14,6 +16,9 @@ os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
 #                   --yaml=barf_strayscanner or iphone
 #                   --name=statue_2 --data.scene=statue --barf_c2f=[0.1,0.5]
 #
+# data-parallel training over several processes/machines (one GPU per process, ranks set up by torchrun):
+# torchrun --nnodes=N --nproc_per_node=P --rdzv_backend=c10d --rdzv_endpoint=host:port train.py ...
+#
 def main():
 
     log.process(os.getpid())
@@ -21,7 +26,11 @@ def main():
 
     opt_cmd = options.parse_arguments(sys.argv[1:])
     opt = options.set(opt_cmd=opt_cmd)
-    options.save_options_file(opt)
+    if opt.world_size>1:
+        torch.distributed.init_process_group(backend=opt.dist.backend,timeout=datetime.timedelta(seconds=opt.dist.timeout))
+        torch.set_num_threads(max(os.cpu_count()//int(os.environ.get("LOCAL_WORLD_SIZE",1)),1))
+        if opt.rank!=0: opt.tb,opt.visdom = None,None # (no logging on the other ranks)
+    if opt.rank==0: options.save_options_file(opt)
 
     with torch.cuda.device(opt.device):
 
@@ -32,9 +41,15 @@ def main():
         m.build_networks(opt)
         m.setup_optimizer(opt)
         m.restore_checkpoint(opt)
+        if opt.world_size>1:
+            # start all ranks from the same weights, then draw different random rays/jitter on each
+            util.broadcast_module(m.graph)
+            torch.manual_seed(opt.seed+opt.rank)
         m.setup_visualizer(opt)
 
         m.train(opt)
 
+    if opt.world_size>1: torch.distributed.destroy_process_group()
+
 if __name__=="__main__":
     main()
@@ -60,6 +60,8 @@ class Log:
         print(yellow(message,bold=True,underline=True))
     def info(self,message):
         print(magenta(message,bold=True))
+    def warning(self,message):
+        print(red(message,bold=True))
     def options(self,opt,level=0):
         for key,value in sorted(opt.items()):
             if isinstance(value,(dict,edict)):
@@ -158,6 +160,29 @@ def save_checkpoint(opt,model,ep,it,latest=False,children=None):
         shutil.copy("{0}/model.ckpt".format(opt.output_path),
                     "{0}/model/{1}.ckpt".format(opt.output_path,ep or it)) # if ep is None, track it instead
 
+def all_reduce_grads(opt,params):
+    # average the gradients over all ranks (the dense ones are flattened into a single buffer)
+    # parameters without gradients are skipped, which is consistent as all ranks run the same graph
+    params = [p for p in params if p.grad is not None]
+    grads = [p.grad for p in params if not p.grad.is_sparse]
+    if grads:
+        grads_flat = torch._utils._flatten_dense_tensors(grads)
+        torch.distributed.all_reduce(grads_flat)
+        grads_flat /= opt.world_size
+        for grad,grad_avg in zip(grads,torch._utils._unflatten_dense_tensors(grads_flat,grads)):
+            grad.copy_(grad_avg)
+    for p in params:
+        if p.grad.is_sparse:
+            # (e.g. the pose refinements with optim.sparse_pose)
+            grad = p.grad.coalesce()
+            torch.distributed.all_reduce(grad)
+            p.grad = grad/opt.world_size
+
+def broadcast_module(module,src=0):
+    # copy the parameters and buffers of rank src to all other ranks
+    for tensor in [*module.parameters(),*module.buffers()]:
+        torch.distributed.broadcast(tensor.data,src=src)
+
 def check_socket_open(hostname,port):
     s = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
     is_open = False